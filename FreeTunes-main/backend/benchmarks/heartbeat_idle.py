@@ -0,0 +1,86 @@
+"""
+Memory and CPU cost of heartbeats for idle websockets.
+
+Compares the old approach (one asyncio task per socket sleeping between
+pings) with the shared time-wheel HeartbeatScheduler in connection_manager.
+The interval is shortened so several ping rounds fit in the measurement.
+
+    python benchmarks/heartbeat_idle.py --sockets 10000 --interval 1 --rounds 5
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from connection_manager import HeartbeatScheduler
+
+class IdleSocket:
+    heartbeat_slot = None
+    missed_pongs = 0
+    answers_pings = False
+
+    async def send_json(self, data):
+        pass
+
+    def ping(self):
+        return True
+
+async def task_per_socket(websocket, interval):
+    # The pre-scheduler routes.heartbeat
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            await websocket.send_json({"type": "ping"})
+    except Exception as e:
+        print(f"Heartbeat error or client disconnected: {e}")
+
+async def measure(label, setup, teardown, duration):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    state = setup()
+    await asyncio.sleep(0)
+    memory = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(before, "filename"))
+    tracemalloc.stop()
+
+    cpu_start = time.process_time()
+    await asyncio.sleep(duration)
+    cpu = time.process_time() - cpu_start
+    await teardown(state)
+    print(f"{label:<16} memory {memory / 1024 / 1024:7.2f} MiB   cpu {cpu * 1000:8.1f} ms over {duration:.0f}s")
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sockets", type=int, default=10000)
+    parser.add_argument("--interval", type=float, default=1.0)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    duration = args.interval * args.rounds
+    sockets = [IdleSocket() for _ in range(args.sockets)]
+
+    def setup_tasks():
+        return [asyncio.create_task(task_per_socket(ws, args.interval)) for ws in sockets]
+
+    async def teardown_tasks(tasks):
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def setup_wheel():
+        scheduler = HeartbeatScheduler(args.interval, 30, 2, None)
+        for ws in sockets:
+            scheduler.register(ws)
+        return scheduler
+
+    async def teardown_wheel(scheduler):
+        await scheduler.stop()
+
+    print(f"{args.sockets} idle sockets, ping every {args.interval}s")
+    await measure("task per socket", setup_tasks, teardown_tasks, duration)
+    await measure("time wheel", setup_wheel, teardown_wheel, duration)
+
+if __name__ == "__main__":
+    asyncio.run(main())
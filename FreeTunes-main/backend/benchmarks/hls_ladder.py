@@ -0,0 +1,78 @@
+"""
+Transcode CPU time and bytes per rendition for the HLS outputs.
+
+Renders a synthetic track (a tone over pink noise, so the encoder has real
+work to do) as AAC the way YouTube serves it, then transcodes it with the
+same ffmpeg arguments controller.py uses:
+
+    copy     - the piped default when an AAC stream is available
+    320k     - the single-rendition re-encode
+    ladder   - one pass producing every rung of --ladder
+
+    python benchmarks/hls_ladder.py --duration 240 --ladder "64k:he,128k,256k"
+"""
+import argparse
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from controller.controller import ffmpeg_hls_command, parse_ladder, fdk_aac
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def render_source(path, duration):
+    subprocess.run([
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+        "-f", "lavfi", "-i", f"anoisesrc=color=pink:amplitude=0.2:duration={duration}",
+        "-filter_complex", "amix=inputs=2,aformat=channel_layouts=stereo",
+        "-c:a", "aac", "-b:a", "128k", path
+    ], check=True)
+
+def rendition_bytes(hls_dir, stem):
+    sizes = defaultdict(int)
+    for name in os.listdir(hls_dir):
+        if name.endswith(".ts"):
+            # <stem>_<generation>_<rendition>_<n>.ts for a ladder, <stem>_<generation>_<n>.ts otherwise
+            parts = name[len(stem):-3].strip("_").split("_")
+            sizes[parts[1] if len(parts) > 2 else "single"] += os.path.getsize(os.path.join(hls_dir, name))
+    return sizes
+
+def run(label, command, hls_dir, stem, duration):
+    cpu_start, wall_start = children_cpu(), time.perf_counter()
+    subprocess.run(command, check=True)
+    cpu, wall = children_cpu() - cpu_start, time.perf_counter() - wall_start
+    print(f"{label:<8} cpu {cpu:6.2f}s  wall {wall:6.2f}s  ({duration / wall:5.0f}x realtime)")
+    for rendition, size in sorted(rendition_bytes(hls_dir, stem).items()):
+        print(f"         {rendition:<8} {size / 1024 / 1024:7.2f} MiB  {size * 8 / duration / 1000:6.1f} kbit/s")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=int, default=240)
+    parser.add_argument("--ladder", default="64k:he,128k,256k")
+    args = parser.parse_args()
+    ladder = parse_ladder(args.ladder)
+    he_aac = asyncio.run(fdk_aac())
+    print(f"{args.duration}s track, ladder {args.ladder}, HE-AAC encoder {'available' if he_aac else 'missing (LC fallback)'}")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        source = os.path.join(workdir, "source.m4a")
+        render_source(source, args.duration)
+
+        for label, copy, rungs in (("copy", True, None), ("320k", False, None), ("ladder", False, ladder)):
+            hls_dir = os.path.join(workdir, label)
+            os.makedirs(hls_dir)
+            hls_file = os.path.join(hls_dir, "track.m3u8")
+            run(label, ffmpeg_hls_command(source, hls_file, copy=copy, ladder=rungs, he_aac=he_aac), hls_dir, "track", args.duration)
+
+if __name__ == "__main__":
+    main()
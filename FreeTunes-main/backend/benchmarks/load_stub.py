@@ -0,0 +1,103 @@
+"""
+Load test for the stream-resolution path against a local stub server.
+
+Starts a tiny HTTP server that answers like the YouTube search API after a
+fixed delay, then resolves N plays concurrently twice: once with the old
+blocking `requests.get` inside a coroutine, once with the shared async client
+used by `controller.get_id_googleapi`. The search cache is swapped for one
+that always misses, so every play reaches the stub and no database is needed.
+
+    python benchmarks/load_stub.py --requests 200 --delay 0.2
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from controller import controller
+from httpclient import http_client
+
+class MissingSearchCache:
+    async def get(self, search_query):
+        return None
+
+    async def set(self, search_query, video_id):
+        pass
+
+STUB_BODY = json.dumps({"items": [{"id": {"videoId": "dQw4w9WgXcQ"}}]}).encode()
+
+async def stub_handler(reader, writer, delay):
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            if not head:
+                break
+            await asyncio.sleep(delay)
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: application/json\r\n"
+                b"Content-Length: " + str(len(STUB_BODY)).encode() + b"\r\n"
+                b"Connection: keep-alive\r\n\r\n" + STUB_BODY
+            )
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionResetError):
+        pass
+    finally:
+        writer.close()
+
+def start_stub(delay):
+    # The stub runs on its own loop so a blocked client loop cannot stall it
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    ports = []
+
+    async def serve():
+        server = await asyncio.start_server(lambda r, w: stub_handler(r, w, delay), "127.0.0.1", 0)
+        ports.append(server.sockets[0].getsockname()[1])
+        ready.set()
+        async with server:
+            await server.serve_forever()
+
+    threading.Thread(target=loop.run_until_complete, args=(serve(),), daemon=True).start()
+    ready.wait()
+    return ports[0]
+
+async def legacy_get_id(url, search_query):
+    # Mirrors the pre-async controller: a blocking call inside a coroutine
+    response = requests.get(url, params={"part": "snippet", "q": search_query})
+    response.raise_for_status()
+    return response.json()['items'][0]['id'].get('videoId')
+
+async def run(n, label, make_call):
+    start = time.perf_counter()
+    results = await asyncio.gather(*(make_call(i) for i in range(n)))
+    elapsed = time.perf_counter() - start
+    ok = sum(1 for r in results if r)
+    print(f"{label:<10} {n} plays in {elapsed:6.2f}s  -> {n / elapsed:8.1f} plays/s  ({ok} resolved)")
+    return elapsed
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--delay", type=float, default=0.2, help="stub upstream latency in seconds")
+    args = parser.parse_args()
+
+    port = start_stub(args.delay)
+    url = f"http://127.0.0.1:{port}/youtube/v3/search"
+    controller.YOUTUBE_SEARCH_URL = url
+    controller.search_cache = MissingSearchCache()
+
+    before = await run(args.requests, "blocking", lambda i: legacy_get_id(url, f"song {i}"))
+    after = await run(args.requests, "async", lambda i: controller.get_id_googleapi(f"song {i}"))
+    print(f"speedup: {before / after:.1f}x")
+    await http_client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,46 @@
+"""
+Times each stage of the resolution pipeline on its own.
+
+Uses the real upstreams configured in client.env, so run it from the backend
+directory with valid keys:
+
+    python benchmarks/pipeline_stages.py "Tum Hi Ho Arijit Singh song" "Believer Imagine Dragons song"
+
+Stages run in order (metadata -> video ID -> stream URL) for every query;
+--stage limits the run to one stage.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from controller.pipeline import resolve_metadata, resolve_video_id, resolve_stream, stage_timings
+from httpclient import http_client
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("queries", nargs="+")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--stage", choices=["metadata", "video_id", "stream"])
+    args = parser.parse_args()
+
+    for _ in range(args.repeat):
+        for query in args.queries:
+            if args.stage in (None, "metadata"):
+                await resolve_metadata(query)
+            if args.stage in (None, "video_id", "stream"):
+                video_id = await resolve_video_id(query)
+                if video_id and args.stage in (None, "stream"):
+                    await resolve_stream(video_id)
+
+    snapshot = stage_timings.snapshot()
+    if args.stage == "stream":
+        snapshot.pop("video_id", None)
+    print(json.dumps(snapshot, indent=2))
+    await http_client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,83 @@
+"""
+Add/remove latency on a playlist against the number of songs it holds.
+
+Seeds a throwaway playlist of each size in a scratch collection, then times
+--rounds add and remove pairs two ways:
+
+    read-modify-write - the old route: find_one, rebuild the songs array in
+                        Python, $set it back whole, find_one again
+    atomic            - the current route: one find_one_and_update with
+                        $push (guarded by $not/$elemMatch) or $pull
+
+Needs a reachable MongoDB; the scratch collection is dropped afterwards.
+
+    python benchmarks/playlist_mutations.py --uri mongodb://localhost:27017 --sizes 100,1000,10000,50000
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+
+def songs(count):
+    return [{"songName": f"Song {index}", "artistName": f"Artist {index % 500}"} for index in range(count)]
+
+async def read_modify_write(collection, playlist_id, action, song):
+    playlist = await collection.find_one({"_id": playlist_id})
+    existing_songs = playlist.get("songs", [])
+    if action == "add":
+        if any(s["songName"] == song["songName"] and s["artistName"] == song["artistName"] for s in existing_songs):
+            return
+        existing_songs.append(song)
+    else:
+        existing_songs = [s for s in existing_songs if not (s["songName"] == song["songName"] and s["artistName"] == song["artistName"])]
+    await collection.update_one({"_id": playlist_id}, {"$set": {"songs": existing_songs}})
+    return await collection.find_one({"_id": playlist_id})
+
+async def atomic(collection, playlist_id, action, song):
+    if action == "add":
+        query = {"_id": playlist_id, "songs": {"$not": {"$elemMatch": song}}}
+        update = {"$push": {"songs": song}}
+    else:
+        query = {"_id": playlist_id}
+        update = {"$pull": {"songs": song}}
+    return await collection.find_one_and_update(query, update, return_document=ReturnDocument.AFTER)
+
+async def measure(collection, size, rounds, mutate):
+    result = await collection.insert_one({"name": "bench", "userID": "bench", "liked": False, "songs": songs(size)})
+    playlist_id = result.inserted_id
+    timings = {"add": [], "remove": []}
+    for index in range(rounds):
+        song = {"songName": f"Bench {index}", "artistName": "Bench"}
+        for action in ("add", "remove"):
+            start = time.perf_counter()
+            await mutate(collection, playlist_id, action, song)
+            timings[action].append(time.perf_counter() - start)
+    await collection.delete_one({"_id": playlist_id})
+    return timings
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--uri", default="mongodb://localhost:27017")
+    parser.add_argument("--db", default="freetunes_bench")
+    parser.add_argument("--sizes", default="100,1000,10000,50000")
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    client = AsyncIOMotorClient(args.uri)
+    collection = client[args.db]["playlist_bench"]
+    try:
+        print(f"{'songs':>7} {'approach':<18} {'add p50':>9} {'remove p50':>11} {'add max':>9}")
+        for size in (int(size) for size in args.sizes.split(",")):
+            for label, mutate in (("read-modify-write", read_modify_write), ("atomic", atomic)):
+                timings = await measure(collection, size, args.rounds, mutate)
+                print(f"{size:7d} {label:<18} {statistics.median(timings['add']) * 1000:7.2f}ms "
+                      f"{statistics.median(timings['remove']) * 1000:9.2f}ms {max(timings['add']) * 1000:7.2f}ms")
+    finally:
+        await collection.drop()
+        client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,92 @@
+"""
+Throughput of the /static HLS mount against the plain StaticFiles mount.
+
+Writes a fake track (playlist plus --segments segments of --segment-kib each)
+to a temp directory and has --clients players fetch every segment through
+httpx's ASGI transport, so only the app is measured, not the network. A
+second round replays the same player with a browser-style cache: requests
+whose Cache-Control still allows reuse are skipped, the rest revalidate
+with If-None-Match.
+
+    python benchmarks/static_segments.py --clients 50 --segments 40
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+from fastapi import FastAPI
+from fastapi.staticfiles import StaticFiles
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from controller.segments import SegmentFiles
+
+def write_track(root, segments, segment_kib):
+    track = os.path.join(root, "track")
+    os.makedirs(track)
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:6", "#EXT-X-MEDIA-SEQUENCE:0"]
+    for index in range(segments):
+        name = f"track{index}.ts"
+        with open(os.path.join(track, name), "wb") as f:
+            f.write(os.urandom(segment_kib * 1024))
+        lines += ["#EXTINF:6.000000,", name]
+    lines.append("#EXT-X-ENDLIST")
+    with open(os.path.join(track, "track.m3u8"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return ["track/track.m3u8"] + [f"track/track{index}.ts" for index in range(segments)]
+
+def app_for(static):
+    app = FastAPI()
+    app.mount("/static", static)
+    return app
+
+def reusable(headers):
+    # What a browser cache may serve without asking the server again
+    cache_control = headers.get("cache-control", "")
+    return "immutable" in cache_control or ("max-age=" in cache_control and "max-age=0" not in cache_control)
+
+async def play(client, paths, cache):
+    fetched = requests = 0
+    for path in paths:
+        cached = cache.get(path)
+        if cached and reusable(cached):
+            continue
+        headers = {"if-none-match": cached["etag"]} if cached and "etag" in cached else {}
+        response = await client.get(f"/static/{path}", headers=headers)
+        requests += 1
+        if response.status_code == 200:
+            cache[path] = response.headers
+        fetched += len(response.content)
+    return fetched, requests
+
+async def measure(label, app, paths, clients):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        caches = [{} for _ in range(clients)]
+        for round_name in ("cold", "reload"):
+            start = time.perf_counter()
+            results = await asyncio.gather(*(play(client, paths, cache) for cache in caches))
+            elapsed = time.perf_counter() - start
+            total = sum(fetched for fetched, _ in results)
+            requests = sum(count for _, count in results)
+            print(f"{label:<12} {round_name:<6} {elapsed:6.2f}s  {requests:6d} requests  {total / 1024 / 1024 / elapsed:8.1f} MiB/s  {total / 1024 / 1024:8.1f} MiB transferred")
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--segments", type=int, default=40)
+    parser.add_argument("--segment-kib", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        paths = write_track(root, args.segments, args.segment_kib)
+        print(f"{args.clients} players x {len(paths)} files ({args.segment_kib} KiB segments)")
+        await measure("StaticFiles", app_for(StaticFiles(directory=root)), paths, args.clients)
+        await measure("SegmentFiles", app_for(SegmentFiles(directory=root)), paths, args.clients)
+
+if __name__ == "__main__":
+    asyncio.run(main())
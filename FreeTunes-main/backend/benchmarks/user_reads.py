@@ -0,0 +1,72 @@
+"""
+Bytes of user document each endpoint pulls from Mongo, before and after the
+projected reads in dal.py.
+
+Builds a synthetic user with --playlists playlist ids and, for accounts not
+yet migrated to the history collection, a --history entry history array,
+then BSON-encodes what every user read returns: the whole document before,
+only the projected fields now. Post-write reads that became
+find_one_and_update replies are counted the same way. No database is
+needed; the sizes are those of the documents Mongo would put on the wire.
+
+    python benchmarks/user_reads.py --playlists 20 --history 0,1000,10000
+"""
+import argparse
+import os
+import sys
+
+import bson
+from bson import ObjectId
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dal
+
+def make_user(playlists, history):
+    return {
+        "_id": ObjectId(),
+        "name": "Benchmark User",
+        "email": "benchmark@example.com",
+        "playlist": [str(ObjectId()) for _ in range(playlists)],
+        "history": [{"songName": f"Song number {index}", "artistName": f"Artist {index % 300}"} for index in range(history)],
+    }
+
+def project(document, projection):
+    # Inclusion projection as Mongo applies it: _id rides along unless excluded
+    fields = {name for name, included in projection.items() if included}
+    if projection.get("_id", 1):
+        fields.add("_id")
+    return {name: value for name, value in document.items() if name in fields}
+
+def size(document):
+    return len(bson.encode(document)) if document else 0
+
+# (endpoint, whole-document user reads before, projected user reads now,
+#  users-collection round-trips before and now). Existence checks on a new
+# email match nothing either way, so they add round-trips but no bytes.
+ENDPOINTS = [
+    ("POST /model/create/user", 1, [dal.USER_PLAYLISTS], 4, 3),
+    ("POST /model/verify/token", 1, [dal.USER_PROFILE], 1, 1),
+    ("PUT /model/update/user/{id}", 1, [dal.USER_PROFILE], 2, 1),
+    ("GET /model/playlist", 1, [dal.USER_PLAYLISTS], 1, 1),
+    ("GET /recommed/g/{id}", 1, [dal.USER_PROFILE], 1, 1),
+    ("POST /model/verify/email", 1, [dal.USER_PROFILE], 1, 1),
+]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--playlists", type=int, default=20)
+    parser.add_argument("--history", default="0,1000,10000")
+    args = parser.parse_args()
+
+    for history in (int(count) for count in args.history.split(",")):
+        user = make_user(args.playlists, history)
+        print(f"\n{args.playlists} playlists, {history} legacy history entries (full document {size(user)} bytes)")
+        print(f"{'endpoint':<32} {'before':>10} {'after':>8} {'saved':>7} {'round-trips':>12}")
+        for endpoint, reads, projections, trips_before, trips_after in ENDPOINTS:
+            before = size(user) * reads
+            after = sum(size(project(user, projection)) for projection in projections)
+            print(f"{endpoint:<32} {before:9d}B {after:7d}B {1 - after / before:6.1%} {trips_before:7d} -> {trips_after}")
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,268 @@
-active_connection = set()
\ No newline at end of file
+from fastapi import WebSocket
+from contextlib import contextmanager
+import asyncio
+import json
+import os
+
+WS_MAX_CONNECTIONS = int(os.getenv('WS_MAX_CONNECTIONS', '10000'))
+WS_MAX_CONNECTIONS_PER_USER = int(os.getenv('WS_MAX_CONNECTIONS_PER_USER', '5'))
+WS_SEND_QUEUE_MAX_BYTES = int(os.getenv('WS_SEND_QUEUE_MAX_BYTES', str(256 * 1024)))
+# How long a producer may wait for queue space before the client is dropped
+WS_SEND_TIMEOUT = float(os.getenv('WS_SEND_TIMEOUT', '10'))
+WS_SHUTDOWN_TIMEOUT = float(os.getenv('WS_SHUTDOWN_TIMEOUT', '5'))
+WS_HEARTBEAT_INTERVAL = float(os.getenv('WS_HEARTBEAT_INTERVAL', '30'))
+WS_HEARTBEAT_SLOTS = int(os.getenv('WS_HEARTBEAT_SLOTS', '30'))
+# Clients that have answered a ping are evicted after this many unanswered ones
+WS_HEARTBEAT_MAX_MISSED = int(os.getenv('WS_HEARTBEAT_MAX_MISSED', '2'))
+
+class ConnectionLimitExceeded(Exception):
+    pass
+
+class Connection:
+    def __init__(self, websocket: WebSocket, max_queued_bytes: int):
+        self.websocket = websocket
+        self.user_id = None
+        self.max_queued_bytes = max_queued_bytes
+        self.queue = asyncio.Queue()
+        self.queued_bytes = 0
+        self.space = asyncio.Condition()
+        self.closed = False
+        self.closing = None
+        self.heartbeat_slot = None
+        self.missed_pongs = 0
+        self.answers_pings = False
+        self.writer = asyncio.create_task(self.write_loop())
+
+    async def write_loop(self):
+        try:
+            while True:
+                item = await self.queue.get()
+                if item is None:
+                    return
+                payload, size = item
+                await self.websocket.send_text(payload)
+                async with self.space:
+                    self.queued_bytes -= size
+                    self.space.notify_all()
+        except Exception as e:
+            print(f"Websocket writer stopped: {e}")
+            self.closed = True
+        finally:
+            # Wake producers blocked on a full queue so they can observe the close
+            async with self.space:
+                self.space.notify_all()
+
+    async def send_text(self, payload: str) -> bool:
+        if self.closed:
+            return False
+
+        size = len(payload.encode())
+        try:
+            async with self.space:
+                await asyncio.wait_for(
+                    self.space.wait_for(lambda: self.closed or self.queued_bytes + size <= self.max_queued_bytes or not self.queued_bytes),
+                    WS_SEND_TIMEOUT
+                )
+                if self.closed:
+                    return False
+                self.queued_bytes += size
+                self.queue.put_nowait((payload, size))
+        except asyncio.TimeoutError:
+            print("Websocket client too slow, dropping connection")
+            manager.dropped_slow += 1
+            self.closing = asyncio.create_task(self.close(code=1013))
+            return False
+        return True
+
+    async def send_json(self, data) -> bool:
+        return await self.send_text(json.dumps(data, separators=(",", ":"), ensure_ascii=False))
+
+    def send_nowait(self, data) -> bool:
+        # Never waits for queue space; used by the heartbeat scheduler
+        if self.closed:
+            return False
+        payload = json.dumps(data, separators=(",", ":"))
+        size = len(payload.encode())
+        if self.queued_bytes and self.queued_bytes + size > self.max_queued_bytes:
+            return False
+        self.queued_bytes += size
+        self.queue.put_nowait((payload, size))
+        return True
+
+    def ping(self) -> bool:
+        # A full queue just skips this ping; only a closed socket counts as dead
+        if self.closed:
+            return False
+        self.missed_pongs += 1
+        self.send_nowait({"type": "ping"})
+        return True
+
+    def mark_pong(self):
+        self.answers_pings = True
+        self.missed_pongs = 0
+
+    async def receive_text(self) -> str:
+        text = await self.websocket.receive_text()
+        # Any inbound frame proves the peer is alive
+        self.missed_pongs = 0
+        return text
+
+    async def close(self, code: int = 1000):
+        if self.closed and self.writer.done():
+            return
+        self.closed = True
+        # Let the writer flush what is already queued, then stop it
+        self.queue.put_nowait(None)
+        try:
+            await asyncio.wait_for(asyncio.shield(self.writer), WS_SHUTDOWN_TIMEOUT)
+        except (asyncio.TimeoutError, Exception):
+            self.writer.cancel()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+class HeartbeatScheduler:
+    def __init__(self, interval: float, slots: int, max_missed: int, on_dead):
+        # A time wheel: one task walks the slots, pinging one slot per tick,
+        # so every connection is pinged once per interval
+        self.interval = interval
+        self.slots = slots
+        self.max_missed = max_missed
+        self.on_dead = on_dead
+        self.wheel = [set() for _ in range(slots)]
+        self.index = 0
+        self.task = None
+        self.evictions = set()
+        self.pings_sent = 0
+        self.evicted = 0
+
+    def register(self, connection: Connection):
+        # The slot just visited comes round again after a full interval
+        slot = (self.index - 1) % self.slots
+        self.wheel[slot].add(connection)
+        connection.heartbeat_slot = slot
+        self.start()
+
+    def unregister(self, connection: Connection):
+        if connection.heartbeat_slot is not None:
+            self.wheel[connection.heartbeat_slot].discard(connection)
+            connection.heartbeat_slot = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            try:
+                self.task = asyncio.get_running_loop().create_task(self.run())
+            except RuntimeError:
+                pass
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        tick = self.interval / self.slots
+        while True:
+            await asyncio.sleep(tick)
+            self.tick()
+
+    def tick(self):
+        bucket = self.wheel[self.index]
+        self.index = (self.index + 1) % self.slots
+        for connection in list(bucket):
+            dead = connection.answers_pings and connection.missed_pongs >= self.max_missed
+            if dead or not connection.ping():
+                self.unregister(connection)
+                self.evicted += 1
+                eviction = asyncio.create_task(self.on_dead(connection))
+                self.evictions.add(eviction)
+                eviction.add_done_callback(self.evictions.discard)
+            else:
+                self.pings_sent += 1
+
+    def stats(self) -> dict:
+        return {
+            "interval": self.interval,
+            "slots": self.slots,
+            "pings_sent": self.pings_sent,
+            "evicted": self.evicted,
+        }
+
+class ConnectionManager:
+    def __init__(self, max_connections: int, max_per_user: int, max_queued_bytes: int):
+        self.max_connections = max_connections
+        self.max_per_user = max_per_user
+        self.max_queued_bytes = max_queued_bytes
+        self.connections = set()
+        self.heartbeat = HeartbeatScheduler(WS_HEARTBEAT_INTERVAL, WS_HEARTBEAT_SLOTS, WS_HEARTBEAT_MAX_MISSED, self.evict)
+        self.by_user = {}
+        self.in_flight = 0
+        self.rejected = 0
+        self.dropped_slow = 0
+
+    def connect(self, websocket: WebSocket) -> Connection:
+        if len(self.connections) >= self.max_connections:
+            self.rejected += 1
+            raise ConnectionLimitExceeded("Server is at its connection limit")
+        connection = Connection(websocket, self.max_queued_bytes)
+        self.connections.add(connection)
+        self.heartbeat.register(connection)
+        return connection
+
+    def assign_user(self, connection: Connection, user_id: str):
+        if not user_id:
+            return
+        user_connections = self.by_user.setdefault(user_id, set())
+        if len(user_connections) >= self.max_per_user:
+            self.rejected += 1
+            raise ConnectionLimitExceeded("Too many connections for this user")
+        user_connections.add(connection)
+        connection.user_id = user_id
+
+    async def disconnect(self, connection: Connection, code: int = 1000):
+        self.connections.discard(connection)
+        self.heartbeat.unregister(connection)
+        if connection.user_id:
+            user_connections = self.by_user.get(connection.user_id)
+            if user_connections is not None:
+                user_connections.discard(connection)
+                if not user_connections:
+                    del self.by_user[connection.user_id]
+        await connection.close(code=code)
+
+    async def evict(self, connection: Connection):
+        print("Evicting websocket with no heartbeat")
+        await self.disconnect(connection, code=1001)
+
+    async def close_all(self, code: int = 1001):
+        await self.heartbeat.stop()
+        connections = list(self.connections)
+        await asyncio.gather(*(self.disconnect(connection, code) for connection in connections), return_exceptions=True)
+
+    @contextmanager
+    def resolution(self):
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "connections": len(self.connections),
+            "users": len(self.by_user),
+            "queued_bytes": sum(connection.queued_bytes for connection in self.connections),
+            "in_flight_resolutions": self.in_flight,
+            "rejected": self.rejected,
+            "dropped_slow": self.dropped_slow,
+            "max_connections": self.max_connections,
+            "max_per_user": self.max_per_user,
+            "heartbeat": self.heartbeat.stats(),
+        }
+
+manager = ConnectionManager(WS_MAX_CONNECTIONS, WS_MAX_CONNECTIONS_PER_USER, WS_SEND_QUEUE_MAX_BYTES)
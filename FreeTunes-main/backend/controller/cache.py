@@ -0,0 +1,216 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from dbconfig import db
+from controller.circuit import circuits, CircuitOpen
+
+REDIS_URL = os.getenv('REDIS_URL')
+STREAM_CACHE_SIZE = int(os.getenv('STREAM_CACHE_SIZE', '5000'))
+STREAM_CACHE_DEFAULT_TTL = int(os.getenv('STREAM_CACHE_DEFAULT_TTL', '1800'))
+# Hand out links with enough life left for a full track to play
+STREAM_CACHE_EXPIRY_MARGIN = int(os.getenv('STREAM_CACHE_EXPIRY_MARGIN', '600'))
+
+class LRUCache:
+    def __init__(self, maxsize: int, default_ttl: float):
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        value, expires_at = entry
+        if expires_at <= time.time():
+            del self.data[key]
+            self.misses += 1
+            return None
+
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.default_ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        self.data[key] = (value, time.time() + ttl)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else None,
+        }
+
+def url_expiry(url: str):
+    # googlevideo links are signed with an absolute unix `expire=` timestamp
+    try:
+        expire = parse_qs(urlparse(url).query).get("expire")
+        return float(expire[0]) if expire else None
+    except (ValueError, TypeError):
+        return None
+
+class StreamCache:
+    def __init__(self, maxsize: int, default_ttl: float, margin: float, redis_url: str = None):
+        self.local = LRUCache(maxsize, default_ttl)
+        self.default_ttl = default_ttl
+        self.margin = margin
+        self.redis = None
+        self.redis_hits = 0
+        if redis_url:
+            try:
+                import redis.asyncio as redis
+                self.redis = redis.from_url(redis_url)
+                print(f"Stream cache using Redis backend at {redis_url}")
+            except Exception as e:
+                print(f"Redis unavailable for stream cache, using in-process cache only: {e}")
+
+    def ttl_for(self, link: str) -> float:
+        expires_at = url_expiry(link)
+        if expires_at is None:
+            return self.default_ttl
+        return expires_at - time.time() - self.margin
+
+    async def get(self, video_id: str):
+        link = self.local.get(video_id)
+        if link or not self.redis:
+            return link
+
+        try:
+            cached = await self.redis.get(f"stream:{video_id}")
+        except Exception as e:
+            print(f"Redis error while reading stream cache: {e}")
+            return None
+
+        if not cached:
+            return None
+
+        link = json.loads(cached)["link"]
+        self.redis_hits += 1
+        self.local.set(video_id, link, self.ttl_for(link))
+        return link
+
+    async def set(self, video_id: str, link: str):
+        ttl = self.ttl_for(link)
+        if ttl <= 0:
+            return
+        self.local.set(video_id, link, ttl)
+
+        if self.redis:
+            try:
+                await self.redis.set(f"stream:{video_id}", json.dumps({"link": link}), ex=int(ttl))
+            except Exception as e:
+                print(f"Redis error while writing stream cache: {e}")
+
+    async def close(self):
+        if self.redis:
+            await self.redis.aclose()
+
+    def stats(self) -> dict:
+        return {**self.local.stats(), "redis": bool(self.redis), "redis_hits": self.redis_hits}
+
+stream_cache = StreamCache(STREAM_CACHE_SIZE, STREAM_CACHE_DEFAULT_TTL, STREAM_CACHE_EXPIRY_MARGIN, REDIS_URL)
+
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', '10000'))
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', str(30 * 24 * 3600)))
+# Cost of one YouTube Data API search.list call
+SEARCH_QUOTA_UNITS = 100
+# The store only saves quota, so a play never waits on it longer than this
+SEARCH_CACHE_STORE_TIMEOUT = float(os.getenv('SEARCH_CACHE_STORE_TIMEOUT', '0.25'))
+
+def normalize_query(search_query: str) -> str:
+    query = " ".join(search_query.lower().split())
+    # The frontend appends " song" to every query, routes.py strips it with [:-4]
+    if query.endswith(" song"):
+        query = query[:-5].rstrip()
+    return query
+
+class SearchCache:
+    def __init__(self, collection, maxsize: int, ttl: float, store_timeout: float):
+        self.collection = collection
+        self.ttl = ttl
+        self.store_timeout = store_timeout
+        self.local = LRUCache(maxsize, ttl)
+        self.store_hits = 0
+        self.upstream_calls = 0
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("createdAt", expireAfterSeconds=int(self.ttl))
+
+    async def store(self, operation):
+        # Bounded, and skipped outright while Mongo keeps timing out, so an
+        # unreachable store costs a play nothing instead of the server
+        # selection timeout
+        with circuits.get("search_store").attempt():
+            return await asyncio.wait_for(operation(), self.store_timeout)
+
+    async def get(self, search_query: str):
+        key = normalize_query(search_query)
+        video_id = self.local.get(key)
+        if video_id:
+            return video_id
+
+        try:
+            doc = await self.store(lambda: self.collection.find_one({"_id": key}, {"videoId": 1}))
+        except CircuitOpen:
+            doc = None
+        except Exception as e:
+            print(f"Error reading search cache: {e!r}")
+            doc = None
+
+        if not doc:
+            # Caller falls through to a YouTube search
+            self.upstream_calls += 1
+            return None
+
+        self.store_hits += 1
+        self.local.set(key, doc["videoId"])
+        return doc["videoId"]
+
+    async def set(self, search_query: str, video_id: str):
+        key = normalize_query(search_query)
+        self.local.set(key, video_id)
+        try:
+            await self.store(lambda: self.collection.update_one(
+                {"_id": key},
+                {"$set": {"videoId": video_id, "createdAt": datetime.utcnow()}},
+                upsert=True
+            ))
+        except CircuitOpen:
+            pass
+        except Exception as e:
+            print(f"Error writing search cache: {e!r}")
+
+    def stats(self) -> dict:
+        hits = self.local.hits + self.store_hits
+        lookups = hits + self.upstream_calls
+        return {
+            "memory": self.local.stats(),
+            "store_hits": self.store_hits,
+            "upstream_calls": self.upstream_calls,
+            "hit_ratio": hits / lookups if lookups else None,
+            "quota_units_saved": hits * SEARCH_QUOTA_UNITS,
+        }
+
+search_cache = SearchCache(db["video_ids"], SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, SEARCH_CACHE_STORE_TIMEOUT)
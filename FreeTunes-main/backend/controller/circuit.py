@@ -0,0 +1,148 @@
+import asyncio
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+
+CIRCUIT_WINDOW = int(os.getenv('CIRCUIT_WINDOW', '20'))
+CIRCUIT_MIN_CALLS = int(os.getenv('CIRCUIT_MIN_CALLS', '5'))
+CIRCUIT_ERROR_RATE = float(os.getenv('CIRCUIT_ERROR_RATE', '0.5'))
+# How long an open circuit skips its upstream before letting a probe through
+CIRCUIT_OPEN_SECONDS = float(os.getenv('CIRCUIT_OPEN_SECONDS', '30'))
+CIRCUIT_HALF_OPEN_PROBES = int(os.getenv('CIRCUIT_HALF_OPEN_PROBES', '1'))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class CircuitOpen(Exception):
+    def __init__(self, name: str):
+        super().__init__(f"Circuit for {name} is open")
+        self.name = name
+
+class CircuitBreaker:
+    def __init__(self, name: str, window: int, min_calls: int, error_rate: float, open_seconds: float, half_open_probes: int, alpha: float = 0.2):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.alpha = alpha
+        self.state = CLOSED
+        self.results = deque(maxlen=window)
+        self.opened_at = 0.0
+        self.probes = 0
+        self.latency = None
+        self.skipped = 0
+        self.opened = 0
+        # Bumped on every state change; results from calls admitted under an
+        # earlier state say nothing about the current one
+        self.generation = 0
+
+    def transition(self, state: str):
+        self.state = state
+        self.generation += 1
+        self.probes = 0
+
+    def available(self) -> bool:
+        # Like allow(), but without claiming a half-open probe or counting a skip
+        if self.state == OPEN:
+            return time.monotonic() - self.opened_at >= self.open_seconds
+        if self.state == HALF_OPEN:
+            return self.probes < self.half_open_probes
+        return True
+
+    def skip(self):
+        self.skipped += 1
+
+    def allow(self) -> bool:
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+            self.transition(HALF_OPEN)
+        if self.state == HALF_OPEN and self.probes < self.half_open_probes:
+            self.probes += 1
+            return True
+        if self.state == CLOSED:
+            return True
+        self.skip()
+        return False
+
+    def record(self, ok: bool, latency: float, generation: int):
+        self.latency = latency if self.latency is None else self.alpha * latency + (1 - self.alpha) * self.latency
+        if generation != self.generation:
+            return
+        if self.state == HALF_OPEN:
+            self.probes -= 1
+            if ok:
+                print(f"Circuit for {self.name} closed")
+                self.transition(CLOSED)
+                self.results.clear()
+            else:
+                self.trip()
+            return
+
+        self.results.append(ok)
+        if self.state == CLOSED and len(self.results) >= self.min_calls and self.failure_rate() >= self.error_rate:
+            self.trip()
+
+    def release(self, generation: int):
+        # A cancelled call says nothing about the upstream; free its probe slot
+        if self.state == HALF_OPEN and generation == self.generation:
+            self.probes = max(0, self.probes - 1)
+
+    def trip(self):
+        print(f"Circuit for {self.name} opened (error rate {self.failure_rate():.0%})")
+        self.transition(OPEN)
+        self.opened_at = time.monotonic()
+        self.opened += 1
+
+    def failure_rate(self) -> float:
+        if not self.results:
+            return 0.0
+        return self.results.count(False) / len(self.results)
+
+    @contextmanager
+    def attempt(self):
+        # Any exception leaving the block counts as a failure of the upstream
+        if not self.allow():
+            raise CircuitOpen(self.name)
+        generation = self.generation
+        start = time.perf_counter()
+        try:
+            yield
+        except asyncio.CancelledError:
+            self.release(generation)
+            raise
+        except Exception:
+            self.record(False, time.perf_counter() - start, generation)
+            raise
+        self.record(True, time.perf_counter() - start, generation)
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "error_rate": self.failure_rate(),
+            "calls_in_window": len(self.results),
+            "latency": self.latency,
+            "opened": self.opened,
+            "skipped": self.skipped,
+            "retry_in": max(0.0, self.open_seconds - (time.monotonic() - self.opened_at)) if self.state == OPEN else 0.0,
+        }
+
+class CircuitRegistry:
+    def __init__(self):
+        self.breakers = {}
+
+    def get(self, name: str) -> CircuitBreaker:
+        breaker = self.breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name, CIRCUIT_WINDOW, CIRCUIT_MIN_CALLS, CIRCUIT_ERROR_RATE, CIRCUIT_OPEN_SECONDS, CIRCUIT_HALF_OPEN_PROBES)
+            self.breakers[name] = breaker
+        return breaker
+
+    def healthy(self) -> bool:
+        return all(breaker.state == CLOSED for breaker in self.breakers.values())
+
+    def snapshot(self) -> dict:
+        return {name: breaker.snapshot() for name, breaker in self.breakers.items()}
+
+circuits = CircuitRegistry()
@@ -1,6 +1,5 @@
 import yt_dlp
 import os 
-import subprocess
 from pathlib import Path
 import json
 import asyncio
@@ -10,8 +9,14 @@ from datetime import datetime, timedelta
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
 from dotenv import load_dotenv
-import requests
+import httpx
 from concurrent.futures import ThreadPoolExecutor
+from httpclient import get_client
+from controller.providers import fetch_first_link
+from controller.circuit import circuits, CircuitOpen
+from controller.cache import stream_cache, search_cache
+from controller.jobs import job_runner, JobFailed
+from controller.segments import segment_cache, playlist_contains
 
 
 dotenv_path = Path('./client.env')
@@ -22,12 +27,33 @@ SPOTIFY_CLIENT_SECRET = str(os.getenv('Client_Secret'))
 YOUTUBE_API_KEY =str(os.getenv('API_KEY_YOUTUBE_GOOGLE'))
 RAPID_API_KEY = str(os.getenv('RAPID_API_KEY'))
 
+YOUTUBE_SEARCH_URL = "https://www.googleapis.com/youtube/v3/search"
+YOUTUBE_SEARCH_TIMEOUT = float(os.getenv('YOUTUBE_SEARCH_TIMEOUT', '5'))
+YTDLP_SEARCH_TIMEOUT = float(os.getenv('YTDLP_SEARCH_TIMEOUT', '30'))
+# piped: yt-dlp streams straight into ffmpeg, mp3: download an MP3 first, then transcode
+HLS_PIPELINE = os.getenv('HLS_PIPELINE', 'piped')
+HLS_FIRST_SEGMENT_TIMEOUT = float(os.getenv('HLS_FIRST_SEGMENT_TIMEOUT', '30'))
+# Shorter segments let playback start sooner, the playlist is handed out after the first one.
+# ffmpeg's -hls_init_time only applies to sliding-window playlists, with a full
+# event playlist it would shorten every segment, so one duration is used throughout
+HLS_SEGMENT_SECONDS = os.getenv('HLS_SEGMENT_SECONDS', '6')
+# Adaptive bitrate renditions, e.g. "64k:he,128k,256k"; empty keeps a single 320k stream
+HLS_LADDER = os.getenv('HLS_LADDER', '')
+
 
 sp = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials(client_id= SPOTIFY_CLIENT_ID, client_secret= SPOTIFY_CLIENT_SECRET))
 
 COOKIES_DIR = 'controller/cookies.txt'
 
-def fetch_initial_link(video_id, api_key):
+# Whether this ffmpeg build ships libfdk_aac, the only encoder with HE-AAC
+fdk_aac_available = None
+
+async def fetch_initial_link(video_id, api_key):
+
+    cached_link = await stream_cache.get(video_id)
+    if cached_link:
+        print(f"Stream link cache hit for video ID: {video_id}")
+        return cached_link
 
     api_list = [
         {   
@@ -71,60 +97,54 @@ def fetch_initial_link(video_id, api_key):
         }
     ]
 
-    for api in api_list:
-        try:
-            print(f"Sending GET Request to API: {api['name']}")
+    link = await fetch_first_link(api_list, extract_audio_link)
+    if not link:
+        print("All API attempts failed.")
+        return None
 
-            response = requests.get(api["url"], headers=api["headers"], params=api["querystring"])
-            response.raise_for_status()
-            print(f"Received response with status code: {response.status_code}")
-            
-            data = response.json()
-            if api["name"] == "YTStream Download" : 
-                if "adaptiveFormats" in data:
-                    adapformat = data["adaptiveFormats"]
-                    for format in adapformat:
-                        if "audio" in format["mimeType"]:
-                            link = format["url"]
-                            print(f"Found audio link: {link}")
-                            return link
-                print("Audio URL not found in response from YTStream Download")
-            
-            elif api["name"] == "YOUTUBE MP4/MP3/M4A CDN":
-                if "formats" in data:
-                    for format in data["formats"]:
-                        if "audio" in format["type"]:
-                            link = format["url"]
-                            print(f"Found audio link: {link}")
-                            return link
-                print("Audio URL not found in response from YOUTUBE MP4/MP3/M4A CDN")
-
-            elif api["name"] == "Youtube Downloader API":
-                if "audio_formats" in data:
-                    for format in data["audio_formats"]:
-                        if "m4a" in format["ext"]:
-                            link = format["url"]
-                            print(f"Found audio link: {link}")
-                            return link
-                print("Audio URL not found in response from Youtube Downloader API")
-
-            elif api["name"] == "YT-Media Downloader":
-                if "audios" in data and "items" in data["audios"]: 
-                    link = data['audios']['items'][0]['url']
-                    if link:
-                        print(link)
-                        return link
-                    else:
-                        print("Audio URL not found in response")
-                else:
-                    print("Audio URL not found in response from YT-Media Downloader")
-                
-        
-        except requests.exceptions.RequestException as e:
-            print(f"Error occurred while fetching initial link from {api['name']}: {e}")
-            continue
+    await stream_cache.set(video_id, link)
+    return link
+
+def extract_audio_link(name, data):
+    if name == "YTStream Download" : 
+        if "adaptiveFormats" in data:
+            adapformat = data["adaptiveFormats"]
+            for format in adapformat:
+                if "audio" in format["mimeType"]:
+                    link = format["url"]
+                    print(f"Found audio link: {link}")
+                    return link
+        print("Audio URL not found in response from YTStream Download")
+    
+    elif name == "YOUTUBE MP4/MP3/M4A CDN":
+        if "formats" in data:
+            for format in data["formats"]:
+                if "audio" in format["type"]:
+                    link = format["url"]
+                    print(f"Found audio link: {link}")
+                    return link
+        print("Audio URL not found in response from YOUTUBE MP4/MP3/M4A CDN")
+
+    elif name == "Youtube Downloader API":
+        if "audio_formats" in data:
+            for format in data["audio_formats"]:
+                if "m4a" in format["ext"]:
+                    link = format["url"]
+                    print(f"Found audio link: {link}")
+                    return link
+        print("Audio URL not found in response from Youtube Downloader API")
+
+    elif name == "YT-Media Downloader":
+        if "audios" in data and "items" in data["audios"]: 
+            link = data['audios']['items'][0]['url']
+            if link:
+                print(link)
+                return link
+            else:
+                print("Audio URL not found in response")
+        else:
+            print("Audio URL not found in response from YT-Media Downloader")
 
-    print("All API attempts failed.")
     return None
 
 # async def songdetails(search_query):
@@ -175,15 +195,6 @@ async def songdetails(search_query: str):
         return None, None
 
 
-async def deletefolder(folder_path:str):
-    await asyncio.sleep(360)
-
-    if os.path.exists(folder_path):
-        shutil.rmtree(folder_path)
-        print(f"Deleted folder: {folder_path}")
-    else:
-        print(f"Folder {folder_path} not found, could not delete")
-
 async def get_id(search_query):
     command = [
         'yt-dlp', 
@@ -195,13 +206,13 @@ async def get_id(search_query):
 
     try:
         
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
+        output = await job_runner.run(command, timeout=YTDLP_SEARCH_TIMEOUT)
         
         
-        print(f"YT-DLP Output: {result.stdout}")  
+        print(f"YT-DLP Output: {output}")  
         
         
-        video_id = result.stdout.strip()  
+        video_id = output.strip()  
         
         if video_id:
             print(f"Video ID: {video_id}")
@@ -209,133 +220,255 @@ async def get_id(search_query):
         else:
             print("No results found")
             return None
-    except subprocess.CalledProcessError as e:
+    except JobFailed as e:
         print(f"Error during yt-dlp execution: {e}")
         print(f"Exit status: {e.returncode}")
         print(f"stdeerr: {e.stderr}")
         return None
+    except asyncio.TimeoutError:
+        print(f"yt-dlp search timed out for: {search_query}")
+        return None
     except Exception as e:
         print(f"Unexpected error: {e}")
         return None
 
-async def search2hls(search_query: str, websocket: WebSocket):
-    async def yt_search(search_query):
-        command = [
-            'yt-dlp', 
-            '--quiet', 
-            '--cookies', COOKIES_DIR, 
-            '--print', 'id',
-            f"ytsearch1:{search_query}"
-        ]
-
-        try:
-            result = subprocess.run(command, capture_output=True, text=True, check=True)
-
-            video_id = result.stdout.strip()  
-        
-            if video_id:
-                print(f"Video ID: {video_id}")
-                return video_id
-            else:
-                print("No results found")
-                return None
-        except subprocess.CalledProcessError as e:
-            print(f"Error during yt-dlp execution: {e}")
-            print(f"Exit status: {e.returncode}")
-            print(f"stdeerr: {e.stderr}")
-            return None
+async def download_audio(video_id):
+    output_dir = "./mp3"
+    os.makedirs(output_dir, exist_ok=True)
+    mp3_file = os.path.join(output_dir, f"{video_id}.mp3")
 
-    async def download_audio(video_id):
-        output_dir = "./mp3"
-        os.makedirs(output_dir, exist_ok=True)
-        mp3_file = os.path.join(output_dir, f"{video_id}.mp3")
-
-        command = [
-            'yt-dlp',
-            '--format', 'bestaudio',
-            '--extract-audio',
-            '--audio-format', 'mp3',
-            '--output', mp3_file,
-            '--audio-quality', '0',
-            '--quiet', 
-            '--cookies', COOKIES_DIR, 
-            f"https://www.youtube.com/watch?v={video_id}"
-        ]
-        
-        print(f"Downloading MP3 for video ID: {video_id}")
-        try:
-            subprocess.run(command, check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"Error during MP3 download: {e}")
-            print(f"Exit status: {e.returncode}")
-            print(f"stdeerr: {e.stderr}")
-            return None
+    command = [
+        'yt-dlp',
+        '--format', 'bestaudio',
+        '--extract-audio',
+        '--audio-format', 'mp3',
+        '--output', mp3_file,
+        '--audio-quality', '0',
+        '--quiet', 
+        '--cookies', COOKIES_DIR, 
+        f"https://www.youtube.com/watch?v={video_id}"
+    ]
+    
+    print(f"Downloading MP3 for video ID: {video_id}")
+    try:
+        await job_runner.run(command, capture_output=False)
+    except JobFailed as e:
+        print(f"Error during MP3 download: {e}")
+        print(f"Exit status: {e.returncode}")
+        print(f"stdeerr: {e.stderr}")
+        return None
+    except asyncio.TimeoutError:
+        print(f"MP3 download timed out for video ID: {video_id}")
+        return None
 
-        if not os.path.exists(mp3_file):
-            print("Failed to download MP3.")
-            return None
-        
-        return mp3_file
-
-    async def convert_hls(video_id, mp3_file):
-        output_dir = "./hls"
-        hls_dir = os.path.join(output_dir, video_id)
-
-        os.makedirs(hls_dir, exist_ok=True)
-        hls_file = os.path.join(hls_dir, f"{video_id}.m3u8")
-
-        print(f"Converting MP3 to HLS format: {hls_file}")
-        command = [
-            "ffmpeg",
-            "-i", mp3_file,
-            "-acodec", "aac",
-            "-b:a", "320k",
-            "-hls_time", "10",
-            "-hls_list_size", "0",
-            "-f", "hls",
-            hls_file
-        ]
+    if not os.path.exists(mp3_file):
+        print("Failed to download MP3.")
+        return None
+    
+    return mp3_file
 
-        try:
-            subprocess.run(command, check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"Error during HLS conversion: {e}")
-            print(f"Exit status: {e.returncode}")
-            print(f"stdeerr: {e.stderr}")
+async def convert_hls(video_id, mp3_file):
+    hls_dir = segment_cache.directory(video_id)
+    hls_file = segment_cache.playlist(video_id)
 
-        print(f"HLS files are saved in: {hls_dir}")
+    print(f"Converting MP3 to HLS format: {hls_file}")
+    command = ffmpeg_hls_command(mp3_file, hls_file, copy=False, ladder=parse_ladder(HLS_LADDER), he_aac=await fdk_aac())
 
+    try:
+        await job_runner.run(command, capture_output=False)
+    except JobFailed as e:
+        print(f"Error during HLS conversion: {e}")
+        print(f"Exit status: {e.returncode}")
+        print(f"stdeerr: {e.stderr}")
+    except asyncio.TimeoutError:
+        print(f"HLS conversion timed out for video ID: {video_id}")
+    finally:
         if os.path.exists(mp3_file):
             os.remove(mp3_file)
             print(f"Deleted the MP3 file: {mp3_file}")
 
-        asyncio.create_task(deletefolder(hls_dir))
+    print(f"HLS files are saved in: {hls_dir}")
+
+async def mp3_transcode(video_id):
+    mp3 = await download_audio(video_id)
+    if not mp3:
+        print("MP3 download failed, aborting.")
+        return
+    await convert_hls(video_id, mp3)
+
+def ytdlp_pipe_command(video_id, audio_format):
+    return [
+        'yt-dlp',
+        '--format', audio_format,
+        '--output', '-',
+        '--quiet',
+        '--cookies', COOKIES_DIR,
+        f"https://www.youtube.com/watch?v={video_id}"
+    ]
+
+def parse_ladder(spec):
+    # "64k:he,128k" -> [("64k", "he"), ("128k", "lc")]
+    ladder = []
+    for rung in spec.split(","):
+        rung = rung.strip()
+        if rung:
+            bitrate, _, profile = rung.partition(":")
+            ladder.append((bitrate, profile or "lc"))
+    return ladder
+
+async def fdk_aac():
+    global fdk_aac_available
+    if fdk_aac_available is None:
+        try:
+            encoders = await job_runner.run(["ffmpeg", "-hide_banner", "-encoders"], timeout=10)
+            fdk_aac_available = "libfdk_aac" in encoders
+        except (JobFailed, asyncio.TimeoutError, OSError) as e:
+            print(f"Could not list ffmpeg encoders: {e}")
+            fdk_aac_available = False
+    return fdk_aac_available
+
+def ladder_codec_args(ladder, he_aac):
+    args = ["-map", "0:a"] * len(ladder)
+    for index, (bitrate, profile) in enumerate(ladder):
+        if profile == "he" and he_aac:
+            args += [f"-c:a:{index}", "libfdk_aac", f"-profile:a:{index}", "aac_he"]
+        else:
+            # The native encoder only does AAC-LC, so HE rungs fall back to LC at the same bitrate
+            args += [f"-c:a:{index}", "aac"]
+        args += [f"-b:a:{index}", bitrate]
+    stream_map = " ".join(f"a:{index},name:{bitrate}" for index, (bitrate, _) in enumerate(ladder))
+    return args + ["-var_stream_map", stream_map]
+
+def ffmpeg_hls_command(source, hls_file, copy, ladder=None, he_aac=False):
+    hls_dir, master = os.path.split(hls_file)
+    stem = master[:-len(".m3u8")]
+    # Segments are served as immutable, so every transcode writes them under
+    # fresh names; a re-transcode with other settings never reuses a name
+    # a browser or CDN already holds
+    generation = os.urandom(4).hex()
+    if ladder:
+        # One decode feeds every rendition; hls_file becomes the master playlist
+        codec = ladder_codec_args(ladder, he_aac) + ["-master_pl_name", master, "-hls_segment_filename", os.path.join(hls_dir, f"{stem}_{generation}_%v_%03d.ts")]
+        output = os.path.join(hls_dir, f"{stem}_%v.m3u8")
+    else:
+        codec = ["-c:a", "copy"] if copy else ["-c:a", "aac", "-b:a", "320k"]
+        codec += ["-hls_segment_filename", os.path.join(hls_dir, f"{stem}_{generation}_%03d.ts")]
+        output = hls_file
+
+    return [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel", "error",
+        "-i", source,
+        "-vn",
+        *codec,
+        "-hls_time", HLS_SEGMENT_SECONDS,
+        "-hls_list_size", "0",
+        # event playlists are rewritten after every segment and only get
+        # EXT-X-ENDLIST at the end, so players can start on the first segment
+        "-hls_playlist_type", "event",
+        "-f", "hls",
+        output
+    ]
+
+def first_segment_ready(hls_file):
+    return playlist_contains(hls_file, "#EXTINF")
+
+async def piped_transcode(video_id, hls_file):
+    ladder = parse_ladder(HLS_LADDER)
+    if ladder:
+        # Every rendition is encoded anyway, so there is nothing to copy
+        await job_runner.run_piped(ytdlp_pipe_command(video_id, 'bestaudio'), ffmpeg_hls_command("pipe:0", hls_file, copy=False, ladder=ladder, he_aac=await fdk_aac()))
+        return
 
-    id = await yt_search(search_query)
+    # Copy YouTube's AAC track straight into segments when there is one,
+    # otherwise decode the best audio once and encode AAC
+    try:
+        await job_runner.run_piped(ytdlp_pipe_command(video_id, 'bestaudio[acodec^=mp4a]'), ffmpeg_hls_command("pipe:0", hls_file, copy=True))
+    except JobFailed as e:
+        if first_segment_ready(hls_file):
+            raise
+        print(f"No AAC stream to copy for {video_id}, re-encoding: {e}")
+        await job_runner.run_piped(ytdlp_pipe_command(video_id, 'bestaudio'), ffmpeg_hls_command("pipe:0", hls_file, copy=False))
+
+def finish_transcode(job, video_id):
+    if not job.cancelled() and job.exception():
+        error = job.exception()
+        print(f"HLS transcode failed for video ID {video_id}: {error}")
+        if isinstance(error, JobFailed):
+            print(f"stdeerr: {error.stderr}")
+
+def start_transcode(video_id):
+    hls_file = segment_cache.playlist(video_id)
+    if HLS_PIPELINE == "piped":
+        return piped_transcode(video_id, hls_file)
+    return mp3_transcode(video_id)
+
+async def stream_to_hls(video_id):
+    hls_file = segment_cache.playlist(video_id)
+
+    print(f"Streaming audio into HLS: {hls_file}")
+    job = segment_cache.transcode(video_id, lambda: start_transcode(video_id), lambda finished: finish_transcode(finished, video_id))
+    segment_cache.acquire(video_id)
+
+    # Hand the playlist out as soon as the first segment exists; the
+    # transcode keeps appending segments in the background
+    deadline = asyncio.get_running_loop().time() + HLS_FIRST_SEGMENT_TIMEOUT
+    try:
+        while not first_segment_ready(hls_file):
+            if job.done():
+                print(f"HLS transcode ended before the first segment for video ID: {video_id}")
+                return None
+            if asyncio.get_running_loop().time() > deadline:
+                print(f"Timed out waiting for the first HLS segment for video ID: {video_id}")
+                return None
+            await asyncio.sleep(0.2)
+    finally:
+        # Only the last request still waiting may abandon a transcode that has no segments yet
+        if segment_cache.release(video_id) and not first_segment_ready(hls_file):
+            job.cancel()
+
+    return await streaming(video_id)
+
+async def video_to_hls(video_id):
+    if segment_cache.lookup(video_id):
+        print(f"HLS cache hit for video ID: {video_id}")
+        return await streaming(video_id)
+
+    if HLS_PIPELINE == "piped":
+        return await stream_to_hls(video_id)
+
+    # The MP3 path only produces a playlist once the whole track is converted
+    job = segment_cache.transcode(video_id, lambda: start_transcode(video_id), lambda finished: finish_transcode(finished, video_id))
+    await asyncio.shield(job)
+    if not segment_cache.ready(video_id):
+        return None
+    return await streaming(video_id)
+
+async def search2hls(search_query: str, websocket: WebSocket):
+    id = await get_id(search_query)
     if not id:
         await websocket.send_text("video id not found, aborting")
         return
 
-    mp3 = await download_audio(id)
-
-    if not mp3:
-        await websocket.send_text("MP3 download failed, aborting.")
-        print("MP3 download failed, aborting.")
+    if not await video_to_hls(id):
+        await websocket.send_text("HLS generation failed, aborting.")
         return
     
-    await convert_hls(id, mp3)    
     return id
 
 async def streaming(id:str):
-    base_dir = "./hls"
-    subfolder_path = Path(base_dir) / id
+    subfolder_path = Path(segment_cache.directory(id))
 
     if not subfolder_path.is_dir():
         return None
+
+    segment_cache.touch(id)
     
-    m3u8_file = list(subfolder_path.glob("*.m3u8"))
-    if m3u8_file:
-        file = m3u8_file[0]
+    # With an adaptive ladder the folder also holds one playlist per rendition
+    m3u8_file = subfolder_path / f"{id}.m3u8"
+    if m3u8_file.exists():
+        file = m3u8_file
         desired_url = str(file)[4:]
         print(desired_url)
         return desired_url
@@ -344,7 +477,11 @@ async def streaming(id:str):
         return None
 
 async def get_id_googleapi(search_query):
-    url = "https://www.googleapis.com/youtube/v3/search"
+    cached_id = await search_cache.get(search_query)
+    if cached_id:
+        print(f"Search cache hit, video ID: {cached_id}")
+        return cached_id
+
     params = {
         "part": "snippet",
         "q": search_query,
@@ -352,9 +489,10 @@ async def get_id_googleapi(search_query):
     }
 
     try:
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        data = response.json()
+        with circuits.get("youtube_search").attempt():
+            response = await get_client().get(YOUTUBE_SEARCH_URL, params=params, timeout=YOUTUBE_SEARCH_TIMEOUT)
+            response.raise_for_status()
+            data = response.json()
 
         if 'items' not in data or not data['items']:
             print(f"No results found for search query: {search_query}")
@@ -363,13 +501,17 @@ async def get_id_googleapi(search_query):
         video_id = data['items'][0]['id'].get('videoId')
         if video_id:
             print(f"Found video ID: {video_id}")
+            await search_cache.set(search_query, video_id)
             return video_id 
         
         else:
             print(f"Video ID not found in response: {data}")
             return None
         
-    except requests.exceptions.RequestException as e:
+    except CircuitOpen as e:
+        print(f"Skipping YouTube search: {e}")
+        return None
+    except httpx.HTTPError as e:
         print(f"Error occurred while searching for the song: {e}")
         return None
     except Exception as e:
@@ -485,61 +627,20 @@ async def get_id_googleapi(search_query):
 #     return id
 
 
-async def search2hls_rapidapi_noHLS(search_query: str, websocket: WebSocket):
- 
-    async def yt_search_googleapi(search_query):
-        url = "https://www.googleapis.com/youtube/v3/search"
-        params = {
-            "part": "snippet",
-            "q": search_query,
-            "key": YOUTUBE_API_KEY
-        }
-
-        try:
-            response = requests.get(url, params=params)
-            response.raise_for_status()
-            data = response.json()
-
-            if 'items' not in data or not data['items']:
-                print(f"No results found for search query: {search_query}")
-                return None
-            
-            video_id = data['items'][0]['id'].get('videoId')
-            if video_id:
-                print(f"Found video ID: {video_id}")
-                return video_id
-            else:
-                print(f"Video ID not found in response: {data}")
-                return None
-        except requests.exceptions.RequestException as e:
-            print(f"Error occurred while searching for the song: {e}")
-            return None   
-
-
-    async def get_streamlink(video_id, api_key):
-        try:
-            print(f"Fetching streamable link for video ID: {video_id}")
-            streamable_link = fetch_initial_link(video_id, api_key)
-            
-            if not streamable_link:
-                print("Failed to get initial link.")
-                return None
-
-            return streamable_link
-
-        except requests.exceptions.RequestException as e:
-            print(f"Error: {e}")
-            return None
-            
-    id = await yt_search_googleapi(search_query)
+async def search2hls_rapidapi_noHLS(search_query: str, websocket: WebSocket, video_id: str = None):
+    # Callers that already resolved the video ID pass it in to skip a second search
+    id = video_id or await get_id_googleapi(search_query)
     if not id:
-        await websocket.send_text("video id not found, aborting")
+        if websocket:
+            await websocket.send_text("video id not found, aborting")
         return
 
-    link = await get_streamlink(id, RAPID_API_KEY)
+    print(f"Fetching streamable link for video ID: {id}")
+    link = await fetch_initial_link(id, RAPID_API_KEY)
 
     if not link:
-        await websocket.send_text("Streamable link not fouund, aborting.")
+        if websocket:
+            await websocket.send_text("Streamable link not fouund, aborting.")
         print("Streamable link not found, aborting.")
         return
 
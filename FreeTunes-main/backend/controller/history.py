@@ -0,0 +1,301 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import BulkWriteError, CollectionInvalid, ConnectionFailure, OperationFailure, PyMongoError, WriteConcernError
+from dbconfig import db
+
+# Plays older than this are dropped by Mongo, which is what bounds the collection
+HISTORY_RETENTION_DAYS = int(os.getenv('HISTORY_RETENTION_DAYS', '365'))
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '50'))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv('HISTORY_MAX_PAGE_SIZE', '200'))
+# How many recent plays ride along with the user in auth responses and seed recommendations
+HISTORY_RECENT_SIZE = int(os.getenv('HISTORY_RECENT_SIZE', '20'))
+# Plays are buffered and written with one insert_many once either threshold is reached
+HISTORY_FLUSH_SIZE = int(os.getenv('HISTORY_FLUSH_SIZE', '100'))
+HISTORY_FLUSH_SECONDS = float(os.getenv('HISTORY_FLUSH_SECONDS', '2'))
+# While Mongo is unreachable the oldest buffered plays are dropped past this
+HISTORY_BUFFER_MAX = int(os.getenv('HISTORY_BUFFER_MAX', '10000'))
+# A play that still fails after this many transient errors is given up on
+HISTORY_MAX_ATTEMPTS = int(os.getenv('HISTORY_MAX_ATTEMPTS', '5'))
+
+# Server error codes worth retrying: elections, shutdowns, timeouts, lost
+# connections. Anything else (duplicate key 11000, validation 121, ...)
+# fails the same way every time.
+TRANSIENT_WRITE_CODES = {6, 7, 50, 64, 89, 91, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436}
+
+EPOCH = datetime(1970, 1, 1)
+
+def encode_cursor(entry: dict) -> str:
+    # Plays can share a millisecond, so _id breaks the tie
+    return f"{(entry['timestamp'] - EPOCH) // timedelta(milliseconds=1)}_{entry['_id']}"
+
+def decode_cursor(cursor: str):
+    # Raises ValueError for anything that is not a cursor we handed out
+    try:
+        milliseconds, entry_id = cursor.split("_")
+        return EPOCH + timedelta(milliseconds=int(milliseconds)), ObjectId(entry_id)
+    except InvalidId as e:
+        raise ValueError(str(e))
+
+def transient(error: Exception) -> bool:
+    if isinstance(error, (ConnectionFailure, WriteConcernError)):
+        return True
+    if isinstance(error, PyMongoError) and error.has_error_label("RetryableWriteError"):
+        return True
+    return isinstance(error, OperationFailure) and error.code in TRANSIENT_WRITE_CODES
+
+def entry_key(entry: dict):
+    # The order history is paged in, newest first when sorted in reverse
+    return (entry["timestamp"], entry["_id"])
+
+class HistoryBuffer:
+    def __init__(self, collection, flush_size: int, flush_seconds: float, max_pending: int, max_attempts: int):
+        self.collection = collection
+        self.flush_size = flush_size
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.pending = []
+        # The batch being written, still visible to readers until it lands
+        self.flushing = []
+        self.timer = None
+        self.flush_task = None
+        # Set by close(), which drains the buffer itself from then on
+        self.closing = False
+        self.buffered = 0
+        self.inserted = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def add(self, entry: dict):
+        self.pending.append(entry)
+        self.buffered += 1
+        if len(self.pending) > self.max_pending:
+            del self.pending[0]
+            self.dropped += 1
+        if len(self.pending) >= self.flush_size:
+            self.schedule_flush()
+        elif self.timer is None and self.flush_task is None and not self.closing:
+            self.timer = asyncio.get_running_loop().call_later(self.flush_seconds, self.schedule_flush)
+
+    def schedule_flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.flush_task is None and self.pending and not self.closing:
+            self.flush_task = asyncio.create_task(self.flush())
+            self.flush_task.add_done_callback(self.flushed)
+
+    def flushed(self, task: asyncio.Task):
+        self.flush_task = None
+        if self.closing:
+            return
+        # Whatever arrived during the write waits for the next threshold
+        if len(self.pending) >= self.flush_size:
+            self.schedule_flush()
+        elif self.pending and self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.flush_seconds, self.schedule_flush)
+
+    async def flush(self) -> bool:
+        batch, self.pending = self.pending, []
+        self.flushing = batch
+        documents = [{name: value for name, value in entry.items() if name != "attempts"} for entry in batch]
+        retry, rejected = [], []
+        try:
+            await self.collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            # Entries without a write error were stored, including those only
+            # missing write concern: sending them again would duplicate them
+            for error in e.details.get("writeErrors", []):
+                if error.get("code") in TRANSIENT_WRITE_CODES:
+                    retry.append(batch[error["index"]])
+                else:
+                    rejected.append(batch[error["index"]])
+            print(f"Error writing {len(retry) + len(rejected)} of {len(batch)} history entries: {e}")
+        except Exception as e:
+            if transient(e):
+                retry = list(batch)
+            else:
+                rejected = list(batch)
+            print(f"Error writing {len(batch)} history entries: {e}")
+        finally:
+            self.flushing = []
+
+        for entry in list(retry):
+            # A write that failed ambiguously may have landed; the retry goes
+            # out as a new document rather than colliding with it forever
+            entry["_id"] = ObjectId()
+            entry["attempts"] = entry.get("attempts", 0) + 1
+            if entry["attempts"] >= self.max_attempts:
+                retry.remove(entry)
+                rejected.append(entry)
+        if rejected:
+            print(f"Dropped {len(rejected)} history entries that cannot be written")
+
+        self.flushes += 1
+        self.inserted += len(batch) - len(retry) - len(rejected)
+        self.rejected += len(rejected)
+        if retry or rejected:
+            self.failed_flushes += 1
+        if retry:
+            # Retried with the next flush, ahead of newer plays
+            self.pending = retry + self.pending
+            overflow = len(self.pending) - self.max_pending
+            if overflow > 0:
+                del self.pending[:overflow]
+                self.dropped += overflow
+        return not retry
+
+    def unflushed(self, user_id: str) -> list:
+        return [entry for entry in self.flushing + self.pending if entry["userID"] == user_id]
+
+    async def close(self):
+        self.closing = True
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        while self.flush_task is not None or self.pending:
+            task = self.flush_task
+            if task is not None:
+                await asyncio.gather(task, return_exceptions=True)
+                if self.flush_task is task:
+                    self.flush_task = None
+                continue
+            if not await self.flush():
+                print(f"Lost {len(self.pending)} history entries on shutdown")
+                return
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self.pending),
+            "buffered": self.buffered,
+            "inserted": self.inserted,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "plays_per_write": self.inserted / self.flushes if self.flushes else None,
+        }
+
+class HistoryStore:
+    def __init__(self, collection_name: str, retention_days: int, page_size: int, max_page_size: int, buffer: HistoryBuffer):
+        self.collection_name = collection_name
+        self.collection = db[collection_name]
+        self.retention = timedelta(days=retention_days)
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+        self.buffer = buffer
+
+    async def ensure_collection(self):
+        # One small insert-only document per play, kept out of the user
+        # document so users stay small no matter how much they listen
+        try:
+            await db.create_collection(
+                self.collection_name,
+                timeseries={"timeField": "timestamp", "metaField": "userID", "granularity": "seconds"},
+                expireAfterSeconds=int(self.retention.total_seconds())
+            )
+            print(f"Created time-series collection {self.collection_name}")
+        except CollectionInvalid:
+            pass
+        except OperationFailure as e:
+            # Servers before 5.0 have no time-series collections: a plain
+            # collection with a TTL index gives the same bound
+            print(f"Time-series collection unavailable ({e}), using a TTL index")
+            await self.collection.create_index("timestamp", expireAfterSeconds=int(self.retention.total_seconds()))
+        await self.collection.create_index([("userID", 1), ("timestamp", -1), ("_id", -1)], name="user_history_page")
+
+    def entry(self, user_id: str, song: str, artist: str, timestamp: datetime = None) -> dict:
+        if timestamp is None:
+            # Truncated the way BSON stores it, so a buffered play sorts and
+            # pages exactly like its stored copy
+            timestamp = datetime.utcnow()
+            timestamp = timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000)
+        return {
+            "_id": ObjectId(),
+            "userID": user_id,
+            "timestamp": timestamp,
+            "songName": song,
+            "artistName": artist,
+        }
+
+    def record(self, user_id: str, song: str, artist: str) -> dict:
+        # Write-behind: the play reaches Mongo with the buffer's next insert_many
+        entry = self.entry(user_id, song, artist)
+        self.buffer.add(entry)
+        return entry
+
+    async def page(self, user_id: str, limit: int = None, before: str = None):
+        # Newest plays first, walking back with the cursor of the oldest play
+        # returned; the page itself comes back oldest to newest like the
+        # history array used to
+        limit = min(limit or self.page_size, self.max_page_size)
+        query = {"userID": user_id}
+        position = decode_cursor(before) if before else None
+        if position:
+            timestamp, entry_id = position
+            query["$or"] = [{"timestamp": {"$lt": timestamp}}, {"timestamp": timestamp, "_id": {"$lt": entry_id}}]
+
+        # Taken before the query so a batch landing meanwhile shows up at
+        # most twice, never zero times; duplicates are dropped below
+        unflushed = [entry for entry in self.buffer.unflushed(user_id) if not position or entry_key(entry) < position]
+        cursor = self.collection.find(query, {"songName": 1, "artistName": 1, "timestamp": 1})
+        entries = await cursor.sort([("timestamp", -1), ("_id", -1)]).limit(limit + 1).to_list(length=limit + 1)
+        if unflushed:
+            seen = {entry["_id"] for entry in entries}
+            entries += [entry for entry in unflushed if entry["_id"] not in seen]
+            entries.sort(key=entry_key, reverse=True)
+        next_cursor = encode_cursor(entries[limit - 1]) if len(entries) > limit else None
+        entries = entries[:limit]
+        entries.reverse()
+        return entries, next_cursor
+
+    async def recent(self, user_id: str, limit: int = HISTORY_RECENT_SIZE) -> list:
+        entries, _ = await self.page(user_id, limit)
+        return [{"songName": entry.get("songName"), "artistName": entry.get("artistName")} for entry in entries]
+
+    async def migrate_user(self, user: dict):
+        # Copies one user's legacy history array, then removes it. Each copy
+        # carries its position in the array, so a run that died halfway
+        # only inserts what is still missing, and the array goes only once
+        # every play is stored. The array has no play times: plays are
+        # placed at account creation, one millisecond apart, in order.
+        user_id = str(user["_id"])
+        history = user.get("history") or []
+        if history:
+            cursor = self.collection.find({"userID": user_id, "legacyIndex": {"$exists": True}}, {"legacyIndex": 1})
+            copied = {doc["legacyIndex"] for doc in await cursor.to_list(length=None)}
+            start = user["_id"].generation_time.replace(tzinfo=None)
+            missing = []
+            for index, item in enumerate(history):
+                if index in copied:
+                    continue
+                entry = self.entry(user_id, item.get("songName"), item.get("artistName"), start + timedelta(milliseconds=index))
+                entry["legacyIndex"] = index
+                missing.append(entry)
+            if missing:
+                await self.collection.insert_many(missing)
+        await db["users"].update_one({"_id": user["_id"]}, {"$unset": {"history": ""}})
+
+    async def migrate(self, batch_size: int, after: ObjectId = None):
+        # Walks users with a history array in _id order, one batch at a
+        # time, yielding the last _id of each batch as a resume point
+        while True:
+            query = {"history": {"$exists": True}}
+            if after is not None:
+                query["_id"] = {"$gt": after}
+            cursor = db["users"].find(query, {"history": 1}).sort("_id", 1).limit(batch_size)
+            users = await cursor.to_list(length=batch_size)
+            if not users:
+                return
+            for user in users:
+                await self.migrate_user(user)
+            after = users[-1]["_id"]
+            yield after, len(users)
+
+history_buffer = HistoryBuffer(db["history"], HISTORY_FLUSH_SIZE, HISTORY_FLUSH_SECONDS, HISTORY_BUFFER_MAX, HISTORY_MAX_ATTEMPTS)
+history_store = HistoryStore("history", HISTORY_RETENTION_DAYS, HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE, history_buffer)
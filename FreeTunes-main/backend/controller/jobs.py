@@ -0,0 +1,142 @@
+import asyncio
+import os
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', str(os.cpu_count() or 2)))
+JOB_TIMEOUT = float(os.getenv('JOB_TIMEOUT', '300'))
+
+class JobFailed(Exception):
+    def __init__(self, command: list, returncode: int, stderr: str):
+        super().__init__(f"{command[0]} exited with status {returncode}")
+        self.command = command
+        self.returncode = returncode
+        self.stderr = stderr
+
+class JobRunner:
+    def __init__(self, workers: int, timeout: float):
+        # Jobs beyond `workers` wait their turn on the semaphore in FIFO order
+        self.workers = workers
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(workers)
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.cancelled = 0
+
+    async def run(self, command: list, timeout: float = None, capture_output: bool = True) -> str:
+        timeout = self.timeout if timeout is None else timeout
+        self.queued += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.queued -= 1
+
+        self.running += 1
+        try:
+            return await self.execute(command, timeout, capture_output)
+        finally:
+            self.running -= 1
+            self.slots.release()
+
+    async def execute(self, command: list, timeout: float, capture_output: bool) -> str:
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdout=asyncio.subprocess.PIPE if capture_output else asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            await self.kill(process)
+            raise
+        except asyncio.CancelledError:
+            # The requester went away; do not leave yt-dlp/ffmpeg running
+            self.cancelled += 1
+            await self.kill(process)
+            raise
+
+        stderr = stderr.decode(errors="replace") if stderr else ""
+        if process.returncode != 0:
+            self.failed += 1
+            raise JobFailed(command, process.returncode, stderr)
+
+        self.completed += 1
+        return stdout.decode(errors="replace") if stdout else ""
+
+    async def run_piped(self, producer: list, consumer: list, timeout: float = None):
+        # producer | consumer as one job holding a single worker slot
+        timeout = self.timeout if timeout is None else timeout
+        self.queued += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.queued -= 1
+
+        self.running += 1
+        try:
+            await self.execute_piped(producer, consumer, timeout)
+        finally:
+            self.running -= 1
+            self.slots.release()
+
+    async def execute_piped(self, producer: list, consumer: list, timeout: float):
+        read_fd, write_fd = os.pipe()
+        try:
+            source = await asyncio.create_subprocess_exec(*producer, stdout=write_fd, stderr=asyncio.subprocess.PIPE)
+            try:
+                sink = await asyncio.create_subprocess_exec(*consumer, stdin=read_fd, stderr=asyncio.subprocess.PIPE)
+            except Exception:
+                await self.kill(source)
+                raise
+        finally:
+            # The children hold their own copies of the pipe ends
+            os.close(read_fd)
+            os.close(write_fd)
+
+        readers = [asyncio.ensure_future(source.communicate()), asyncio.ensure_future(sink.communicate())]
+        try:
+            _, pending = await asyncio.wait(readers, timeout=timeout)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            await self.stop_piped(source, sink, readers)
+            raise
+
+        if pending:
+            self.timed_out += 1
+            await self.stop_piped(source, sink, readers)
+            raise asyncio.TimeoutError()
+
+        (_, source_err), (_, sink_err) = readers[0].result(), readers[1].result()
+
+        for process, command, stderr in ((source, producer, source_err), (sink, consumer, sink_err)):
+            if process.returncode != 0:
+                self.failed += 1
+                raise JobFailed(command, process.returncode, stderr.decode(errors="replace") if stderr else "")
+
+        self.completed += 1
+
+    async def stop_piped(self, source, sink, readers: list):
+        await self.kill(source)
+        await self.kill(sink)
+        # The readers finish on their own once both processes are gone
+        await asyncio.gather(*readers, return_exceptions=True)
+
+    async def kill(self, process):
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "cancelled": self.cancelled,
+        }
+
+job_runner = JobRunner(JOB_WORKERS, JOB_TIMEOUT)
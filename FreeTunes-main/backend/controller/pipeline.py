@@ -0,0 +1,202 @@
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from functools import wraps
+from pathlib import Path
+import httpx
+from dotenv import load_dotenv
+from httpclient import HTTPClient
+from controller.controller import get_id_googleapi, fetch_initial_link, video_to_hls, RAPID_API_KEY
+from controller.cache import LRUCache, normalize_query
+from controller.singleflight import SingleFlight
+from controller.circuit import circuits, CircuitOpen
+
+dotenv_path = Path('./client.env')
+load_dotenv(dotenv_path=dotenv_path)
+
+SPOTIFY_SERVER_URL = str(os.getenv('SPOTIFY_SERVER_URL'))
+# direct: hand out the upstream audio URL, hls: transcode locally and serve /static
+STREAM_MODE = os.getenv('STREAM_MODE', 'direct')
+SPOTIFY_SERVER_TIMEOUT = float(os.getenv('SPOTIFY_SERVER_TIMEOUT', '5'))
+SPOTIFY_CONNECT_TIMEOUT = float(os.getenv('SPOTIFY_CONNECT_TIMEOUT', '2'))
+SPOTIFY_MAX_CONNECTIONS = int(os.getenv('SPOTIFY_MAX_CONNECTIONS', '100'))
+SPOTIFY_MAX_KEEPALIVE = int(os.getenv('SPOTIFY_MAX_KEEPALIVE', '50'))
+SPOTIFY_RETRIES = int(os.getenv('SPOTIFY_RETRIES', '2'))
+SPOTIFY_RETRY_BACKOFF = float(os.getenv('SPOTIFY_RETRY_BACKOFF', '0.1'))
+SPOTIFY_BULK_MAX = int(os.getenv('SPOTIFY_BULK_MAX', '100'))
+METADATA_CACHE_SIZE = int(os.getenv('METADATA_CACHE_SIZE', '10000'))
+METADATA_CACHE_TTL = float(os.getenv('METADATA_CACHE_TTL', '86400'))
+
+class StageTimings:
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self.samples = {}
+
+    def record(self, stage: str, elapsed: float):
+        self.samples.setdefault(stage, deque(maxlen=self.window)).append(elapsed)
+
+    def snapshot(self) -> dict:
+        result = {}
+        for stage, samples in self.samples.items():
+            ordered = sorted(samples)
+            result[stage] = {
+                "count": len(ordered),
+                "p50": ordered[len(ordered) // 2],
+                "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                "max": ordered[-1],
+            }
+        return result
+
+stage_timings = StageTimings()
+
+# Long-lived keep-alive pool for the hop to the Spotify micro-service, opened
+# and closed by the app lifespan
+spotify_client = HTTPClient(SPOTIFY_SERVER_TIMEOUT, SPOTIFY_CONNECT_TIMEOUT, SPOTIFY_MAX_CONNECTIONS, SPOTIFY_MAX_KEEPALIVE, name="Spotify server")
+spotify_hop = {"requests": 0, "retries": 0, "errors": 0}
+
+# Spotify's answer for a query rarely changes, and prefetching relies on it being cached
+metadata_cache = LRUCache(METADATA_CACHE_SIZE, METADATA_CACHE_TTL)
+
+# A popular track requested by many listeners at once costs one upstream call per stage
+flights = {
+    "metadata": SingleFlight(),
+    "video_id": SingleFlight(),
+    "stream": SingleFlight(),
+}
+
+def timed(stage: str):
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                stage_timings.record(stage, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+class RetryableError(Exception):
+    pass
+
+async def post_spotify(url: str, **kwargs) -> httpx.Response:
+    # Transport errors and 5xx are retried with full-jitter exponential backoff;
+    # every attempt goes through the circuit breaker and is timed
+    for attempt in range(SPOTIFY_RETRIES + 1):
+        if attempt:
+            spotify_hop["retries"] += 1
+            await asyncio.sleep(random.uniform(0, SPOTIFY_RETRY_BACKOFF * 2 ** attempt))
+        spotify_hop["requests"] += 1
+        start = time.perf_counter()
+        try:
+            with circuits.get("spotify_server").attempt():
+                response = await spotify_client.get_client().post(url, **kwargs)
+                # A 404 for an unknown song is a healthy answer, only server errors count against it
+                if response.status_code >= 500:
+                    raise RetryableError(f"Spotify server returned {response.status_code}")
+            return response
+        except (httpx.TransportError, RetryableError) as e:
+            spotify_hop["errors"] += 1
+            print(f"Spotify server attempt {attempt + 1} failed: {e}")
+            if attempt == SPOTIFY_RETRIES:
+                raise
+        finally:
+            stage_timings.record("spotify_hop", time.perf_counter() - start)
+
+async def spotify_server(query: str, server_url: str):
+    try:
+        url = f"{server_url}/spotify"
+        response = await post_spotify(url, params={"query": query})
+
+        if response.status_code == 200:
+            data = response.json()
+            print(f"Artist: {data['artist']}, Song: {data['song']}")
+            return data
+        else:
+            print(f"Error {response.status_code}: {response.json().get('detail')}")
+            return None
+    except CircuitOpen as e:
+        print(f"Skipping Spotify lookup: {e}")
+        return None
+    except Exception as e:
+        print(f"Request failed: {e}")
+        return None
+
+async def spotify_server_bulk(queries: list, server_url: str) -> dict:
+    # query -> {"artist", "song"} for every query the server could resolve
+    found = {}
+    for offset in range(0, len(queries), SPOTIFY_BULK_MAX):
+        try:
+            response = await post_spotify(f"{server_url}/spotify/bulk", json={"queries": queries[offset:offset + SPOTIFY_BULK_MAX]})
+            response.raise_for_status()
+            for item in response.json()["results"]:
+                if "artist" in item:
+                    found[item["query"]] = {"artist": item["artist"], "song": item["song"]}
+        except CircuitOpen as e:
+            print(f"Skipping Spotify bulk lookup: {e}")
+            break
+        except Exception as e:
+            print(f"Bulk request failed: {e}")
+    return found
+
+# Stage 1: search query -> {"artist", "song"}
+@timed("metadata")
+async def resolve_metadata(search_query: str):
+    key = normalize_query(search_query)
+    cached = metadata_cache.get(key)
+    if cached:
+        return cached
+    return await flights["metadata"].do(key, lambda: fetch_metadata(key, search_query[:-4]))
+
+async def warm_metadata(search_queries: list):
+    # One bulk hop for every query not cached yet, instead of one hop per song
+    missing = {}
+    for search_query in search_queries:
+        key = normalize_query(search_query)
+        if not metadata_cache.get(key):
+            missing.setdefault(search_query[:-4], key)
+    if not missing:
+        return
+    found = await spotify_server_bulk(list(missing), SPOTIFY_SERVER_URL)
+    for updated_query, data in found.items():
+        metadata_cache.set(missing[updated_query], data)
+
+async def fetch_metadata(key: str, updated_query: str):
+    data = await spotify_server(updated_query, SPOTIFY_SERVER_URL)
+    if data:
+        metadata_cache.set(key, data)
+    return data
+
+# Stage 2: search query -> YouTube video ID (the only search round-trip per play)
+@timed("video_id")
+async def resolve_video_id(search_query: str):
+    return await flights["video_id"].do(normalize_query(search_query), lambda: get_id_googleapi(search_query))
+
+# Stage 3: video ID -> streamable audio URL (or HLS playlist path)
+@timed("stream")
+async def resolve_stream(video_id: str):
+    return await flights["stream"].do(video_id, lambda: stream_link(video_id))
+
+async def stream_link(video_id: str):
+    if STREAM_MODE == "hls":
+        print(f"Generating HLS for video ID: {video_id}")
+        return await video_to_hls(video_id)
+
+    print(f"Fetching streamable link for video ID: {video_id}")
+    link = await fetch_initial_link(video_id, RAPID_API_KEY)
+    if not link:
+        print("Streamable link not found.")
+    return link
+
+async def resolve(search_query: str) -> dict:
+    metadata = await resolve_metadata(search_query) or {}
+    video_id = await resolve_video_id(search_query)
+    link = await resolve_stream(video_id) if video_id else None
+    return {
+        "artist": metadata.get("artist"),
+        "song": metadata.get("song"),
+        "id": video_id,
+        "file": link
+    }
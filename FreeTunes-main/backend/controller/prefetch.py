@@ -0,0 +1,76 @@
+import asyncio
+import os
+from controller.cache import LRUCache, normalize_query
+from controller.pipeline import resolve
+
+PREFETCH_DEPTH = int(os.getenv('PREFETCH_DEPTH', '3'))
+PREFETCH_MAX_DEPTH = int(os.getenv('PREFETCH_MAX_DEPTH', '10'))
+# Kept low so background warming never competes with tracks being played right now
+PREFETCH_CONCURRENCY = int(os.getenv('PREFETCH_CONCURRENCY', '2'))
+PREFETCH_MAX_PENDING = int(os.getenv('PREFETCH_MAX_PENDING', '200'))
+# A track warmed this recently is not resolved again
+PREFETCH_RECENT_TTL = float(os.getenv('PREFETCH_RECENT_TTL', '600'))
+
+def track_query(item: dict) -> str:
+    # Same shape as the frontend's search query, so the warmed cache keys match
+    return f"{item.get('songName') or ''} {item.get('artistName') or ''} song"
+
+class Prefetcher:
+    def __init__(self, resolve, concurrency: int, max_pending: int, recent_ttl: float):
+        self.resolve = resolve
+        self.slots = asyncio.Semaphore(concurrency)
+        self.max_pending = max_pending
+        self.pending = {}
+        self.recent = LRUCache(max_pending * 10, recent_ttl)
+        self.scheduled = 0
+        self.skipped = 0
+        self.completed = 0
+        self.failed = 0
+
+    def schedule(self, queries: list) -> int:
+        scheduled = 0
+        for query in queries:
+            key = normalize_query(query)
+            if not key or key in self.pending or self.recent.get(key) or len(self.pending) >= self.max_pending:
+                self.skipped += 1
+                continue
+            task = asyncio.create_task(self.warm(key, query))
+            self.pending[key] = task
+            task.add_done_callback(lambda finished, key=key: self.pending.pop(key, None))
+            scheduled += 1
+        self.scheduled += scheduled
+        return scheduled
+
+    async def warm(self, key: str, query: str):
+        async with self.slots:
+            try:
+                # Resolving fills the metadata, search and stream (or HLS) caches
+                result = await self.resolve(query)
+            except Exception as e:
+                print(f"Prefetch failed for {query}: {e}")
+                self.failed += 1
+                return
+
+        if result.get("file"):
+            self.recent.set(key, True)
+            self.completed += 1
+        else:
+            print(f"Prefetch found no stream for {query}")
+            self.failed += 1
+
+    async def close(self):
+        tasks = list(self.pending.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self.pending),
+            "scheduled": self.scheduled,
+            "skipped": self.skipped,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+prefetcher = Prefetcher(resolve, PREFETCH_CONCURRENCY, PREFETCH_MAX_PENDING, PREFETCH_RECENT_TTL)
@@ -0,0 +1,134 @@
+import asyncio
+import os
+import time
+import httpx
+from httpclient import get_client
+from controller.circuit import circuits, CircuitOpen
+
+# sequential: one provider at a time, hedged: start the next provider after
+# HEDGE_DELAY seconds without an answer, parallel: all providers at once
+PROVIDER_MODE = os.getenv('PROVIDER_MODE', 'hedged')
+HEDGE_DELAY = float(os.getenv('HEDGE_DELAY', '1.5'))
+RAPID_API_TIMEOUT = float(os.getenv('RAPID_API_TIMEOUT', '8'))
+
+class ProviderStats:
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.stats = {}
+
+    def record(self, name: str, latency: float, ok: bool, cancelled: bool = False):
+        entry = self.stats.setdefault(name, {"attempts": 0, "successes": 0, "failures": 0, "cancelled": 0, "latency": None, "cancelled_after": 0.0})
+        # A cancelled hedge lost the race: it was cut short, so its elapsed
+        # time is no latency sample, only a lower bound on the provider's
+        # latency, and it says nothing about success rate
+        if cancelled:
+            entry["cancelled"] += 1
+            entry["cancelled_after"] = max(entry["cancelled_after"], latency)
+            return
+        entry["cancelled_after"] = 0.0
+        entry["attempts"] += 1
+        if ok:
+            entry["successes"] += 1
+        else:
+            entry["failures"] += 1
+        if entry["latency"] is None:
+            entry["latency"] = latency
+        else:
+            entry["latency"] = self.alpha * latency + (1 - self.alpha) * entry["latency"]
+
+    def score(self, name: str) -> float:
+        # Expected seconds until a usable link; lower is better
+        entry = self.stats.get(name)
+        if not entry or not entry["attempts"] + entry["cancelled"]:
+            return 0.0
+        # A provider that keeps losing hedges is at least as slow as it was
+        # when last cut off, even if it has never finished a request
+        latency = max(entry["latency"] or 0.0, entry["cancelled_after"])
+        success_rate = entry["successes"] / entry["attempts"] if entry["attempts"] else 1.0
+        return latency / max(success_rate, 0.05)
+
+    def order(self, api_list: list) -> list:
+        # Untried providers score 0 so each one gets measured at least once
+        return sorted(api_list, key=lambda api: self.score(api["name"]))
+
+    def snapshot(self) -> dict:
+        return {
+            name: {
+                **entry,
+                "success_rate": entry["successes"] / entry["attempts"] if entry["attempts"] else None,
+                "score": self.score(name),
+            }
+            for name, entry in self.stats.items()
+        }
+
+provider_stats = ProviderStats()
+
+async def query_provider(api: dict, extract_link):
+    start = time.perf_counter()
+    link = None
+    try:
+        with circuits.get(api["name"]).attempt():
+            print(f"Sending GET Request to API: {api['name']}")
+            response = await get_client().get(api["url"], headers=api["headers"], params=api["querystring"], timeout=RAPID_API_TIMEOUT)
+            response.raise_for_status()
+            print(f"Received response with status code: {response.status_code}")
+            data = response.json()
+        link = extract_link(api["name"], data)
+    except CircuitOpen as e:
+        print(f"Skipping {api['name']}: {e}")
+        return None
+    except asyncio.CancelledError:
+        provider_stats.record(api["name"], time.perf_counter() - start, False, cancelled=True)
+        raise
+    except (httpx.HTTPError, ValueError, KeyError, IndexError, TypeError) as e:
+        print(f"Error occurred while fetching initial link from {api['name']}: {e}")
+    provider_stats.record(api["name"], time.perf_counter() - start, bool(link))
+    return link
+
+async def fetch_sequential(api_list: list, extract_link):
+    for api in api_list:
+        link = await query_provider(api, extract_link)
+        if link:
+            return link
+    return None
+
+async def fetch_hedged(api_list: list, extract_link, delay: float):
+    remaining = list(api_list)
+    pending = set()
+    try:
+        while remaining or pending:
+            if remaining:
+                pending.add(asyncio.create_task(query_provider(remaining.pop(0), extract_link)))
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=delay if remaining else None,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                link = task.result()
+                if link:
+                    return link
+    finally:
+        for task in pending:
+            task.cancel()
+    return None
+
+async def fetch_first_link(api_list: list, extract_link, mode: str = PROVIDER_MODE, delay: float = HEDGE_DELAY):
+    # Providers behind an open circuit are left out instead of being waited on
+    available = []
+    for api in provider_stats.order(api_list):
+        breaker = circuits.get(api["name"])
+        if breaker.available():
+            available.append(api)
+        else:
+            breaker.skip()
+    api_list = available
+    if not api_list:
+        print("Every stream provider is behind an open circuit")
+        return None
+
+    if mode == "sequential":
+        return await fetch_sequential(api_list, extract_link)
+    if mode == "parallel":
+        return await fetch_hedged(api_list, extract_link, 0)
+    return await fetch_hedged(api_list, extract_link, delay)
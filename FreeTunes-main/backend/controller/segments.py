@@ -0,0 +1,266 @@
+from fastapi.staticfiles import StaticFiles
+from starlette.staticfiles import NotModifiedResponse
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from pathlib import Path
+import asyncio
+import os
+import shutil
+import time
+
+HLS_DIR = "hls"
+HLS_CACHE_MAX_BYTES = int(os.getenv('HLS_CACHE_MAX_BYTES', str(2 * 1024 * 1024 * 1024)))
+# A track fetched within this window is treated as playing and never evicted
+HLS_CACHE_PIN_SECONDS = float(os.getenv('HLS_CACHE_PIN_SECONDS', '300'))
+# lru: evict the least recently played track, lfu: the least played, oldest first
+HLS_CACHE_POLICY = os.getenv('HLS_CACHE_POLICY', 'lru')
+# Finished playlists only change if the track is evicted and transcoded again
+HLS_PLAYLIST_MAX_AGE = int(os.getenv('HLS_PLAYLIST_MAX_AGE', '10'))
+HLS_SEND_CHUNK_BYTES = int(os.getenv('HLS_SEND_CHUNK_BYTES', str(512 * 1024)))
+# mimetypes maps .ts to Qt translation files
+HLS_MEDIA_TYPES = {".ts": "video/mp2t", ".m3u8": "application/vnd.apple.mpegurl"}
+
+class SegmentEntry:
+    def __init__(self, video_id: str, size: int = 0, last_access: float = None, complete: bool = False):
+        self.video_id = video_id
+        self.size = size
+        self.last_access = last_access or time.time()
+        self.hits = 0
+        self.complete = complete
+        self.waiters = 0
+
+class SegmentCache:
+    def __init__(self, root: str, max_bytes: int, pin_seconds: float, policy: str):
+        # One directory per video ID, so a track is transcoded once and every
+        # later play is served from disk until the size budget pushes it out
+        self.root = root
+        self.max_bytes = max_bytes
+        self.pin_seconds = pin_seconds
+        self.policy = policy
+        self.entries = {}
+        self.transcodes = {}
+        self.cleanups = set()
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evicted = 0
+        self.evicted_bytes = 0
+
+    def directory(self, video_id: str) -> str:
+        return os.path.join(self.root, video_id)
+
+    def playlist(self, video_id: str) -> str:
+        return os.path.join(self.directory(video_id), f"{video_id}.m3u8")
+
+    def load(self):
+        # Keep finished tracks from the previous run, drop half-written ones
+        os.makedirs(self.root, exist_ok=True)
+        for path in Path(self.root).iterdir():
+            if not path.is_dir():
+                continue
+            playlist = path / f"{path.name}.m3u8"
+            if playlist_complete(str(playlist)):
+                self.entries[path.name] = SegmentEntry(path.name, directory_size(str(path)), playlist.stat().st_mtime, complete=True)
+            else:
+                shutil.rmtree(path, ignore_errors=True)
+        print(f"HLS cache loaded {len(self.entries)} tracks, {self.total_bytes() / 1024 / 1024:.1f} MiB")
+        self.schedule_cleanup()
+
+    def touch(self, video_id: str):
+        entry = self.entries.get(video_id)
+        if entry:
+            entry.last_access = time.time()
+
+    def ready(self, video_id: str) -> bool:
+        entry = self.entries.get(video_id)
+        return bool(entry and entry.complete and os.path.exists(self.playlist(video_id)))
+
+    def lookup(self, video_id: str) -> bool:
+        if self.ready(video_id):
+            entry = self.entries[video_id]
+            entry.last_access = time.time()
+            entry.hits += 1
+            self.hits += 1
+            return True
+        return False
+
+    def transcode(self, video_id: str, start, on_finish=None) -> asyncio.Task:
+        # Concurrent requests for one video share the transcode already writing its directory
+        job = self.transcodes.get(video_id)
+        if job:
+            self.shared += 1
+            return job
+
+        self.misses += 1
+        os.makedirs(self.directory(video_id), exist_ok=True)
+        self.entries[video_id] = SegmentEntry(video_id)
+        job = asyncio.create_task(start())
+        self.transcodes[video_id] = job
+        job.add_done_callback(lambda finished: self.finish(video_id, finished))
+        if on_finish:
+            # Registered once per transcode, however many requests end up sharing it
+            job.add_done_callback(on_finish)
+        return job
+
+    def finish(self, video_id: str, job: asyncio.Task):
+        self.transcodes.pop(video_id, None)
+        entry = self.entries.get(video_id)
+        if job.cancelled() or job.exception() or not playlist_complete(self.playlist(video_id)):
+            self.entries.pop(video_id, None)
+            self.schedule_cleanup(video_id)
+            return
+        if entry:
+            entry.complete = True
+            entry.size = directory_size(self.directory(video_id))
+        self.schedule_cleanup()
+
+    def acquire(self, video_id: str):
+        entry = self.entries.get(video_id)
+        if entry:
+            entry.waiters += 1
+
+    def release(self, video_id: str) -> bool:
+        # True when no other request is still waiting on this transcode
+        entry = self.entries.get(video_id)
+        if not entry:
+            return True
+        entry.waiters -= 1
+        return entry.waiters <= 0
+
+    def pinned(self, entry: SegmentEntry, now: float) -> bool:
+        return entry.video_id in self.transcodes or entry.waiters > 0 or now - entry.last_access < self.pin_seconds
+
+    def total_bytes(self) -> int:
+        return sum(entry.size for entry in self.entries.values())
+
+    def victims(self) -> list:
+        now = time.time()
+        candidates = [entry for entry in self.entries.values() if entry.complete and not self.pinned(entry, now)]
+        if self.policy == "lfu":
+            candidates.sort(key=lambda entry: (entry.hits, entry.last_access))
+        else:
+            candidates.sort(key=lambda entry: entry.last_access)
+
+        excess = self.total_bytes() - self.max_bytes
+        chosen = []
+        for entry in candidates:
+            if excess <= 0:
+                break
+            chosen.append(entry)
+            excess -= entry.size
+        return chosen
+
+    def schedule_cleanup(self, *video_ids: str):
+        cleanup = asyncio.get_running_loop().create_task(self.cleanup(video_ids))
+        self.cleanups.add(cleanup)
+        cleanup.add_done_callback(self.cleanups.discard)
+
+    async def cleanup(self, video_ids: tuple):
+        for video_id in video_ids:
+            if video_id not in self.entries:
+                await asyncio.to_thread(shutil.rmtree, self.directory(video_id), True)
+
+        for entry in self.victims():
+            # Drop the entry first so nothing hands out a playlist being deleted
+            self.entries.pop(entry.video_id, None)
+            self.evicted += 1
+            self.evicted_bytes += entry.size
+            print(f"Evicting HLS cache entry: {entry.video_id} ({entry.size} bytes)")
+            await asyncio.to_thread(shutil.rmtree, self.directory(entry.video_id), True)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "tracks": len(self.entries),
+            "bytes": self.total_bytes(),
+            "max_bytes": self.max_bytes,
+            "transcoding": len(self.transcodes),
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared_transcodes": self.shared,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evicted": self.evicted,
+            "evicted_bytes": self.evicted_bytes,
+            "policy": self.policy,
+        }
+
+def read_playlist(playlist: str) -> str:
+    try:
+        with open(playlist) as f:
+            return f.read()
+    except FileNotFoundError:
+        return ""
+
+def variant_playlists(playlist: str) -> list:
+    # A master playlist points at one media playlist per rendition
+    text = read_playlist(playlist)
+    if not text:
+        return []
+    if "#EXT-X-STREAM-INF" not in text:
+        return [playlist]
+    base = os.path.dirname(playlist)
+    return [os.path.join(base, line.strip()) for line in text.splitlines() if line.strip() and not line.startswith("#")]
+
+def playlist_contains(playlist: str, marker: str) -> bool:
+    variants = variant_playlists(playlist)
+    return bool(variants) and all(marker in read_playlist(variant) for variant in variants)
+
+def playlist_complete(playlist: str) -> bool:
+    return playlist_contains(playlist, "#EXT-X-ENDLIST")
+
+def directory_size(path: str) -> int:
+    try:
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+    except FileNotFoundError:
+        return 0
+
+class SegmentResponse(FileResponse):
+    # Segments are a few hundred KiB, so one or two reads cover a whole file
+    chunk_size = HLS_SEND_CHUNK_BYTES
+
+    async def __call__(self, scope, receive, send):
+        extensions = scope.get("extensions") or {}
+        whole_file = scope["method"].upper() != "HEAD" and "range" not in Headers(scope=scope)
+
+        # Let the server hand the file to the kernel when it supports it
+        if whole_file and "http.response.pathsend" in extensions:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            await send({"type": "http.response.pathsend", "path": os.path.abspath(self.path)})
+        elif whole_file and "http.response.zerocopy" in extensions:
+            with open(self.path, "rb") as file:
+                await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+                await send({"type": "http.response.zerocopy", "file": file, "more_body": False})
+        else:
+            await super().__call__(scope, receive, send)
+
+class SegmentFiles(StaticFiles):
+    # /static mount for HLS: cache headers per file type, and tracks a player
+    # is fetching stay pinned in the segment cache
+    async def get_response(self, path: str, scope):
+        response = await super().get_response(path, scope)
+        if response.status_code in (200, 304):
+            segment_cache.touch(Path(path).parts[0])
+        return response
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200):
+        headers = {"cache-control": self.cache_control(str(full_path))}
+        media_type = HLS_MEDIA_TYPES.get(os.path.splitext(full_path)[1])
+        response = SegmentResponse(full_path, status_code=status_code, headers=headers, media_type=media_type, stat_result=stat_result)
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
+
+    def cache_control(self, full_path: str) -> str:
+        if full_path.endswith(".ts"):
+            # Segment names carry the transcode's generation, so a name is
+            # never written twice with different bytes
+            return "public, max-age=31536000, immutable"
+        if full_path.endswith(".m3u8"):
+            video_id = Path(full_path).parent.name
+            if video_id in segment_cache.transcodes:
+                # Event playlists grow with every new segment
+                return "no-cache"
+            return f"public, max-age={HLS_PLAYLIST_MAX_AGE}"
+        return "no-cache"
+
+segment_cache = SegmentCache(HLS_DIR, HLS_CACHE_MAX_BYTES, HLS_CACHE_PIN_SECONDS, HLS_CACHE_POLICY)
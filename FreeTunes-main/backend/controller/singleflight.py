@@ -0,0 +1,49 @@
+import asyncio
+
+class Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+class SingleFlight:
+    def __init__(self):
+        # Concurrent callers with the same key await one shared task instead
+        # of each repeating the upstream work
+        self.flights = {}
+        self.started = 0
+        self.shared = 0
+        self.abandoned = 0
+
+    async def do(self, key, start):
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = Flight(asyncio.create_task(start()))
+            self.flights[key] = flight
+            self.started += 1
+            flight.task.add_done_callback(lambda finished: self.forget(key, flight))
+        else:
+            self.shared += 1
+
+        flight.waiters += 1
+        try:
+            # shield: one caller going away must not cancel the others' result
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                # Nobody is left to use the result
+                self.abandoned += 1
+                self.forget(key, flight)
+                flight.task.cancel()
+
+    def forget(self, key, flight: Flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self.flights),
+            "started": self.started,
+            "shared": self.shared,
+            "abandoned": self.abandoned,
+        }
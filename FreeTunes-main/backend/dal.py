@@ -0,0 +1,39 @@
+from typing import Optional
+from bson import ObjectId
+from pymongo import ReturnDocument
+from dbconfig import db
+
+# Projections for user reads. Every helper takes one, so a route only ever
+# pulls the fields it returns instead of the whole user document.
+USER_PROFILE = {"name": 1, "email": 1, "playlist": 1}
+USER_PLAYLISTS = {"playlist": 1}
+USER_ID = {"_id": 1}
+
+def as_object_id(user_id) -> ObjectId:
+    return user_id if isinstance(user_id, ObjectId) else ObjectId(user_id)
+
+async def find_user(user_id, projection: dict) -> Optional[dict]:
+    return await db["users"].find_one({"_id": as_object_id(user_id)}, projection)
+
+async def find_user_by_email(email: str, projection: dict) -> Optional[dict]:
+    return await db["users"].find_one({"email": email}, projection)
+
+async def user_exists(email: str) -> bool:
+    return await find_user_by_email(email, USER_ID) is not None
+
+async def insert_user(user_data: dict) -> ObjectId:
+    result = await db["users"].insert_one(user_data)
+    return result.inserted_id
+
+async def update_user(user_id, update: dict, projection: dict) -> Optional[dict]:
+    # The write and the read-back are one round-trip; None if no user matched
+    return await db["users"].find_one_and_update(
+        {"_id": as_object_id(user_id)}, update,
+        projection=projection, return_document=ReturnDocument.AFTER
+    )
+
+async def add_user_playlist(user_id, playlist_id) -> bool:
+    result = await db["users"].update_one(
+        {"_id": as_object_id(user_id)}, {"$push": {"playlist": str(playlist_id)}}
+    )
+    return result.matched_count > 0
@@ -19,4 +19,12 @@ class MongoDB:
         return self.database
     
 mongodb = MongoDB(MONGO_URI, DB_NAME)
-db = mongodb.get_database()
\ No newline at end of file
+db = mongodb.get_database()
+
+async def ensure_indexes():
+    # Multikey index so the liked check on every play is one index lookup,
+    # however many songs the liked playlist holds
+    await db["playlist"].create_index(
+        [("userID", 1), ("liked", 1), ("songs.songName", 1), ("songs.artistName", 1)],
+        name="liked_song_lookup"
+    )
@@ -0,0 +1,36 @@
+import httpx
+import os
+
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '10'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '3'))
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '500'))
+HTTP_MAX_KEEPALIVE = int(os.getenv('HTTP_MAX_KEEPALIVE', '100'))
+
+class HTTPClient:
+    def __init__(self, timeout: float, connect_timeout: float, max_connections: int, max_keepalive: int, name: str = "Shared"):
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+        self.name = name
+        self.client = None
+
+    def get_client(self) -> httpx.AsyncClient:
+        # Created lazily so the pool is bound to the running event loop
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+        return self.client
+
+    def open(self):
+        # Called from the app lifespan so the first request does not pay for it
+        self.get_client()
+        print(f"{self.name} HTTP client opened")
+
+    async def close(self):
+        if self.client is not None and not self.client.is_closed:
+            await self.client.aclose()
+            print(f"{self.name} HTTP client closed")
+        self.client = None
+
+http_client = HTTPClient(HTTP_TIMEOUT, HTTP_CONNECT_TIMEOUT, HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE)
+
+def get_client() -> httpx.AsyncClient:
+    return http_client.get_client()
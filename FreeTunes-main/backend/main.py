@@ -1,8 +1,7 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from routes.routes import router
-from fastapi.staticfiles import StaticFiles
-from dbconfig import MongoDB
+from dbconfig import MongoDB, ensure_indexes
 from dotenv import load_dotenv
 from pathlib import Path
 import os
@@ -11,17 +10,40 @@ from fastapi import APIRouter, HTTPException, Depends, Response, Request, Backgr
 from spotifyapi import recommendations
 from routes.authentication import model_router
 from contextlib import asynccontextmanager
-from connection_manager import active_connection
+from connection_manager import manager
+from httpclient import http_client
+from controller.cache import stream_cache, search_cache
+from controller.segments import segment_cache, SegmentFiles, HLS_DIR
+from controller.prefetch import prefetcher
+from controller.pipeline import spotify_client
+from controller.history import history_store, history_buffer
 
-hls_directory = "hls"
-
-os.makedirs(hls_directory, exist_ok=True)
+os.makedirs(HLS_DIR, exist_ok=True)
 
 @asynccontextmanager
 async def lifespan(app:FastAPI):
+    try:
+        await search_cache.ensure_indexes()
+    except Exception as e:
+        print(f"Error creating search cache indexes: {e}")
+    try:
+        await ensure_indexes()
+    except Exception as e:
+        print(f"Error creating playlist indexes: {e}")
+    try:
+        await history_store.ensure_collection()
+    except Exception as e:
+        print(f"Error preparing the history collection: {e}")
+    segment_cache.load()
+    spotify_client.open()
     yield
-    for ws in active_connection:
-        await ws.close(code=1001)
+    await manager.close_all(code=1001)
+    await prefetcher.close()
+    # Writes out plays still waiting in the buffer
+    await history_buffer.close()
+    await http_client.close()
+    await spotify_client.close()
+    await stream_cache.close()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -44,7 +66,7 @@ async def get_message(request: Request):
     return {"message": "This is a test message."}
 
 
-app.mount("/static", StaticFiles(directory="hls"))
+app.mount("/static", SegmentFiles(directory=HLS_DIR))
 app.include_router(router)
 app.include_router(recommendations, prefix="/recommed", tags=["Recommendations"])
 app.include_router(model_router, prefix="/model", tags=["Users"])
@@ -0,0 +1,32 @@
+"""
+One-off move of the history arrays left on user documents into the history
+collection. Run it once after deploying, outside the app:
+
+    python migrate_history.py --batch-size 500
+
+It prints the last user _id of every batch. Stopping and re-running is
+safe; --after <_id> skips the users a previous run already got through.
+"""
+import argparse
+import asyncio
+
+from bson import ObjectId
+
+from controller.history import history_store
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--after", help="resume after this user _id")
+    args = parser.parse_args()
+
+    await history_store.ensure_collection()
+    after = ObjectId(args.after) if args.after else None
+    total = 0
+    async for last_id, migrated in history_store.migrate(args.batch_size, after):
+        total += migrated
+        print(f"Migrated {total} users, resume with --after {last_id}")
+    print(f"Done: moved the history of {total} users")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,10 +1,12 @@
 from fastapi import APIRouter, HTTPException, Depends, Response, Request, BackgroundTasks
 from models.model import user, playlist, PlaylistItem
 from dbconfig import db
+import dal
 from pymongo.errors import PyMongoError
 from pydantic import BaseModel, EmailStr
 from typing import Optional, List
 from routes.model import model_router
+from controller.history import history_store
 import urllib.request
 import json
 from pathlib import Path
@@ -53,7 +55,7 @@ async def verify_email(request: VerifyEmail, response: Response):
         except Exception as e:
                 raise HTTPException(status_code=400, detail={"email":email,"verified":False,"message":"User email ID not found in the response."})
 
-        user = await db["users"].find_one({"email": email})
+        user = await dal.find_user_by_email(email, dal.USER_PROFILE)
         
         if not user:
             raise HTTPException(status_code=404, detail={"email":email,"verified":False, "message":"User not found"})
@@ -71,7 +73,7 @@ async def verify_email(request: VerifyEmail, response: Response):
                 "name": user["name"],
                 "email": user["email"],
                 "playlist": user.get("playlist", []),
-                "history": user.get("history", []),
+                "history": await history_store.recent(str(user["_id"])),
             }
         }
     
@@ -93,9 +95,7 @@ async def verify_email_new(request: VerifyEmail, response: Response):
         except Exception as e:
                 raise HTTPException(status_code=400, detail={"email":email,"verified":False,"message":"User email ID not found in the response."})
 
-        user = await db["users"].find_one({"email": email})
-
-        if user:
+        if await dal.user_exists(email):
             raise HTTPException(status_code=404, detail={"email":email,"verified":False, "message":"User already exists"})
 
         return{
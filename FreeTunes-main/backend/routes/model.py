@@ -11,8 +11,11 @@ from pathlib import Path
 import os
 from models.model import user, playlist, PlaylistItem
 from dbconfig import db
+import dal
 from pymongo.errors import PyMongoError
+from pymongo import ReturnDocument
 from fastapi.security import OAuth2PasswordBearer
+from controller.history import history_store
 from typing import Optional, List
 
 
@@ -48,6 +51,11 @@ class PlaylistUpdateResponse(BaseModel):
         arbitrary_types_allowed = True
         json_encoders = {ObjectId: str}
 
+class HistoryPage(BaseModel):
+    items: List[PlaylistItem]
+    # Pass back as `before` for the next (older) page; null on the last page
+    next: Optional[str] = None
+
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
     if expires_delta:
@@ -234,24 +242,24 @@ async def create_user(item: user, request: Request):
 
         print(item.name)
         print(item.email)
-        existing_user = await db["users"].find_one({"email": item.email})
-        if existing_user:
+        if await dal.user_exists(item.email):
             print(f"User with email {item.email} already exists.")
             raise HTTPException(status_code=400, detail={"status": False, "message": "A user with this email already exists."})
         
         
         item_dict = item.dict(by_alias=True)
-        item_dict["history"] = []
-        result = await db["users"].insert_one(item_dict)
-        print(f"Item inserted with ID: {result.inserted_id}")
+        # Plays live in the history collection, not on the user
+        item_dict.pop("history", None)
+        user_id = await dal.insert_user(item_dict)
+        print(f"Item inserted with ID: {user_id}")
         
         access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-        token_data = {"user_id": str(result.inserted_id), "email": item.email}
+        token_data = {"user_id": str(user_id), "email": item.email}
         token = create_access_token(data=token_data, expires_delta=access_token_expires)
         
         default_playlist = playlist(
             name="Liked",
-            userID=str(result.inserted_id),
+            userID=str(user_id),
             songs=[],
             liked=True
         )
@@ -260,15 +268,11 @@ async def create_user(item: user, request: Request):
         playlist_result = await db["playlist"].insert_one(playlist_dict)
         print(f"Liked playllist inserted with ID : {playlist_result.inserted_id}")
 
-        await db["users"].update_one(
-            {"_id": result.inserted_id},
-            {"$set": {"playlist": [str(playlist_result.inserted_id)]}}
+        created_item = await dal.update_user(
+            user_id,
+            {"$set": {"playlist": [str(playlist_result.inserted_id)]}},
+            dal.USER_PLAYLISTS
         )
-
-        created_item = await db["users"].find_one({"_id": result.inserted_id})
-        
-        if created_item:
-            created_item["_id"] = str(created_item["_id"])
         
         if not created_item:
             raise HTTPException(status_code=404, detail={"status": False, "message": "Failed to retrieve the created item from the database"})
@@ -280,7 +284,7 @@ async def create_user(item: user, request: Request):
                 "name": item.name,  # Ensure name is returned
                 "email": item.email,  # Ensure email is returned
                 "playlist": created_item.get("playlist", []),
-                "history": created_item.get("history", []),
+                "history": [],
             },
             "access_token": token
         }
@@ -304,10 +308,7 @@ async def verify_token(request: TokenRequest):
         if not user_id:
             raise HTTPException(status_code=401, detail={"auth" : False, "message": ""})
         
-        user_data = await db["users"].find_one({"_id": ObjectId(user_id)})
-
-        if user_data:
-            user_data["_id"] = str(user_data["_id"])
+        user_data = await dal.find_user(user_id, dal.USER_PROFILE)
 
         if not user_data:
             raise HTTPException(status_code=401, detail={"auth" : False, "message": "Unauthorized: User not found."})
@@ -320,7 +321,7 @@ async def verify_token(request: TokenRequest):
                 "name": user_data["name"],  # Ensure name is returned
                 "email": user_data["email"],  # Ensure email is returned
                 "playlist": user_data.get("playlist", []),
-                "history": user_data.get("history", []),
+                "history": await history_store.recent(user_id),
             }}
 
     except Exception as e:
@@ -349,20 +350,11 @@ async def create_playlist(item: playlist, request: Request):
         result = await db["playlist"].insert_one(playlist_dict)
         print(f"Playlist inserted with ID: {result.inserted_id}")
         
-        created_playlist = await db["playlist"].find_one({"_id": result.inserted_id})
-        if created_playlist:
-            created_playlist["_id"] = str(created_playlist["_id"])
-        if not created_playlist:
-            raise HTTPException(status_code=404, detail="Failed to retrieve the created playlist from the database.")
+        # insert_one stored exactly this document, so it is returned as is
+        created_playlist = playlist_dict
+        created_playlist["_id"] = str(result.inserted_id)
         
-        update_result = await db["users"].update_one(
-            {"_id": ObjectId(user_id)}, 
-            {"$push": {"playlist": str(result.inserted_id)}}
-        )
-
-        print(update_result)
-
-        if update_result.matched_count == 0:
+        if not await dal.add_user_playlist(user_id, result.inserted_id):
             raise HTTPException(status_code=404, detail="User not found while updating playlists.")
         
         return created_playlist
@@ -394,21 +386,14 @@ async def update_user(user_id: str, updated_data: user, request: Request):
         if not ObjectId.is_valid(user_id):
             raise HTTPException(status_code=400, detail="Invalid user ID format.")
         
-        updated_data_dict = updated_data.dict(exclude_unset=True, by_alias=True)
-        
-        result = await db["users"].update_one(
-            {"_id": ObjectId(user_id)}, {"$set": updated_data_dict}
-        )
+        # History is written through /update/history only
+        updated_data_dict = updated_data.dict(exclude_unset=True, by_alias=True, exclude={"history"})
         
-        if result.matched_count == 0:
+        updated_user = await dal.update_user(user_id, {"$set": updated_data_dict}, dal.USER_PROFILE)
+        if not updated_user:
             raise HTTPException(status_code=404, detail="User not found.")
         
-        updated_user = await db["users"].find_one({"_id": ObjectId(user_id)})
-        if updated_user:
-            updated_user["_id"] = str(updated_user["_id"])
-
-        if not updated_user:
-            raise HTTPException(status_code=404, detail="User not found after update.")
+        updated_user["_id"] = str(updated_user["_id"])
         
         return updated_user
 
@@ -419,6 +404,50 @@ async def update_user(user_id: str, updated_data: user, request: Request):
         print(f"Error while updating user: {e}")
         raise HTTPException(status_code=500, detail="An unexpected error occurred while updating the user.")
 
+async def apply_playlist_action(playlist_id: str, user_id: str, updated_data: PlaylistUpdateRequest, duplicate_is_error: bool):
+    # One atomic update per add/remove: the songs array is never read into
+    # Python or written back whole, so concurrent edits cannot overwrite each other
+    action = updated_data.action
+    song = updated_data.song
+
+    if not song or not song.songName or not song.artistName:
+        raise HTTPException(status_code=400, detail="Song information missing or invalid.")
+
+    match = {"songName": song.songName, "artistName": song.artistName}
+    query = {"_id": ObjectId(playlist_id), "userID": user_id}
+    if action == "add":
+        # Only matches while the song is absent, so a duplicate is never pushed
+        query["songs"] = {"$not": {"$elemMatch": match}}
+        update = {"$push": {"songs": song.dict()}}
+    elif action == "remove":
+        update = {"$pull": {"songs": match}}
+    else:
+        raise HTTPException(status_code=400, detail="Invalid action. Use 'add' or 'remove'.")
+
+    # Ownership comes from the token, so userID is not taken from the body
+    fields = updated_data.dict(exclude_unset=True, exclude={"action", "song", "userID"})
+    if fields:
+        update["$set"] = fields
+
+    updated_playlist = await db["playlist"].find_one_and_update(query, update, return_document=ReturnDocument.AFTER)
+    if updated_playlist:
+        return updated_playlist
+
+    # Nothing matched: work out why without loading the songs array
+    existing = await db["playlist"].find_one({"_id": ObjectId(playlist_id)}, {"userID": 1})
+    if not existing:
+        raise HTTPException(status_code=404, detail="Playlist not found.")
+    if existing.get("userID") != user_id:
+        raise HTTPException(status_code=403, detail="Forbidden: You can only update your own playlists.")
+    if duplicate_is_error:
+        raise HTTPException(status_code=400, detail="Song already exists in the playlist.")
+
+    # Adding a song that is already there is a no-op for the popup
+    owned = {"_id": ObjectId(playlist_id), "userID": user_id}
+    if fields:
+        return await db["playlist"].find_one_and_update(owned, {"$set": fields}, return_document=ReturnDocument.AFTER)
+    return await db["playlist"].find_one(owned)
+
 @model_router.put("/update/playlist/{playlist_id}", response_model=PlaylistUpdateResponse)
 async def update_playlist(playlist_id: str, updated_data: PlaylistUpdateRequest, request: Request):
     try:
@@ -441,63 +470,9 @@ async def update_playlist(playlist_id: str, updated_data: PlaylistUpdateRequest,
         print(f"Attempting to update playlist with ID: {playlist_id}")
         if not ObjectId.is_valid(playlist_id):
             raise HTTPException(status_code=400, detail="Invalid playlist ID format.")
-        
-        playlist = await db["playlist"].find_one({"_id": ObjectId(playlist_id)})
-        if not playlist:
-            raise HTTPException(status_code=404, detail="Playlist not found.")
-        
-        if playlist.get("userID") != user_id:
-            raise HTTPException(status_code=403, detail="Forbidden: You can only update your own playlists.")
-        
-        # Handle the action and song update
-        action = updated_data.action
-        song = updated_data.song
-
-        if not song or not song.songName or not song.artistName:
-            raise HTTPException(status_code=400, detail="Song information missing or invalid.")
-
-        # Get the existing songs from the playlist
-        existing_songs = playlist.get("songs", [])
-
-        # Convert existing songs to dictionaries (in case they're objects)
-        existing_songs = [
-            song.dict() if isinstance(song, PlaylistItem) else song
-            for song in existing_songs
-        ]
-
-        # Add or remove the song based on the action
-        if action == "add":
-            if any(existing_song['songName'] == song.songName and existing_song['artistName'] == song.artistName for existing_song in existing_songs):
-                raise HTTPException(status_code=400, detail="Song already exists in the playlist.")
-            existing_songs.append(song.dict())
-        elif action == "remove":
-            existing_songs = [
-                existing_song for existing_song in existing_songs
-                if not (existing_song['songName'] == song.songName and existing_song['artistName'] == song.artistName)
-            ]
-        else:
-            raise HTTPException(status_code=400, detail="Invalid action. Use 'add' or 'remove'.")
-
-        # Update the playlist
-        updated_data_dict = updated_data.dict(exclude_unset=True)
-        updated_data_dict['songs'] = existing_songs  # Ensure songs are dictionaries
-        updated_data_dict.pop('action', None) 
-
-        result = await db["playlist"].update_one(
-            {"_id": ObjectId(playlist_id)}, {"$set": updated_data_dict}
-        )
-        
-        if result.matched_count == 0:
-            raise HTTPException(status_code=404, detail="Playlist not found.")
-        
-        # Fetch and return the updated playlist
-        updated_playlist = await db["playlist"].find_one({"_id": ObjectId(playlist_id)})
-        if updated_playlist:
-            updated_playlist["_id"] = str(updated_playlist["_id"])
-        
-        if not updated_playlist:
-            raise HTTPException(status_code=404, detail="Playlist not found after update.")
-        
+
+        updated_playlist = await apply_playlist_action(playlist_id, user_id, updated_data, duplicate_is_error=True)
+        updated_playlist["_id"] = str(updated_playlist["_id"])
         return PlaylistUpdateResponse(**updated_playlist)
 
     except HTTPException as e:
@@ -523,7 +498,7 @@ async def get_playlist(request : Request):
         if not user_id:
             raise HTTPException(status_code=401, detail="Unauthoriized: User ID missing")
         
-        user_data = await db["users"].find_one({"_id":ObjectId(user_id)})
+        user_data = await dal.find_user(user_id, dal.USER_PLAYLISTS)
 
         if not user_data:
             raise HTTPException(status_code=401, detail="user not found")
@@ -629,74 +604,9 @@ async def update_playlist_popup(playlist_id :str, updated_data: PlaylistUpdateRe
         print(f"Attempting to update playlist with ID: {playlist_id}")
         if not ObjectId.is_valid(playlist_id):
             raise HTTPException(status_code=400, detail="Invalid playlist ID format.")
-        
-        playlist = await db["playlist"].find_one({"_id": ObjectId(playlist_id)})
-        if not playlist:
-            raise HTTPException(status_code=404, detail="Playlist not found.")
-        
-        if playlist.get("userID") != user_id:
-            raise HTTPException(status_code=403, detail="Forbidden: You can only update your own playlists.")
-        
-        # Handle the action and song update
-        action = updated_data.action
-        song = updated_data.song
-
-        if not song or not song.songName or not song.artistName:
-            raise HTTPException(status_code=400, detail="Song information missing or invalid.")
-
-        # Get the existing songs from the playlist
-        existing_songs = playlist.get("songs", [])
-
-        # Convert existing songs to dictionaries (in case they're objects)
-        existing_songs = [
-            song.dict() if isinstance(song, PlaylistItem) else song
-            for song in existing_songs
-        ]
-
-        # Add or remove the song based on the action
-        # if action == "add":
-        #     if not any(existing_song['songName'] == song.songName and existing_song['artistName'] == song.artistName for existing_song in existing_songs):
-        #         existing_songs.append(song.dict())
-        # elif action == "remove":
-        #     existing_songs = [
-        #         existing_song for existing_song in existing_songs
-        #         if not (existing_song['songName'] == song.songName and existing_song['artistName'] == song.artistName)
-        #     ]
-        # else:
-        #     raise HTTPException(status_code=400, detail="Invalid action. Use 'add' or 'remove'.")
-
-        if action == "add":
-            if not any(existing_song['songName'] == song.songName and existing_song['artistName'] == song.artistName for existing_song in existing_songs):
-                existing_songs.append(song.dict())
-        elif action == "remove":
-            if any(existing_song['songName'] == song.songName and existing_song['artistName'] == song.artistName for existing_song in existing_songs):
-                existing_songs = [
-                    existing_song for existing_song in existing_songs
-                    if not (existing_song['songName'] == song.songName and existing_song['artistName'] == song.artistName)
-                ]
-        else:
-            raise HTTPException(status_code=400, detail="Invalid action. Use 'add' or 'remove'.")
-
-        # Update the playlist
-        updated_data_dict = updated_data.dict(exclude_unset=True)
-        updated_data_dict['songs'] = existing_songs  # Ensure songs are dictionaries
-        updated_data_dict.pop('action', None) 
-
-        result = await db["playlist"].update_one(
-            {"_id": ObjectId(playlist_id)}, {"$set": updated_data_dict}
-        )
-        
-        if result.matched_count == 0:
-            raise HTTPException(status_code=404, detail="Playlist not found.")
-        
-        # Fetch and return the updated playlist
-        updated_playlist = await db["playlist"].find_one({"_id": ObjectId(playlist_id)})
-        if updated_playlist:
-            updated_playlist["_id"] = str(updated_playlist["_id"])
-        
-        if not updated_playlist:
-            raise HTTPException(status_code=404, detail="Playlist not found after update.")
-        
+
+        updated_playlist = await apply_playlist_action(playlist_id, user_id, updated_data, duplicate_is_error=False)
+        updated_playlist["_id"] = str(updated_playlist["_id"])
         return PlaylistUpdateResponse(**updated_playlist)
 
     except HTTPException as e:
@@ -706,7 +616,7 @@ async def update_playlist_popup(playlist_id :str, updated_data: PlaylistUpdateRe
         print(f"Error while updating playlist: {e}")
         raise HTTPException(status_code=500, detail="An unexpected error occurred while updating the playlist.")    
 
-@model_router.put("/update/history", response_model=user)
+@model_router.put("/update/history", response_model=PlaylistItem, status_code=202)
 async def update_song_history(song_data: dict, request: Request):
     print("Received request at the endpoint")  
     try:
@@ -721,6 +631,8 @@ async def update_song_history(song_data: dict, request: Request):
             raise HTTPException(status_code=401, detail="Unauthorized: Invalid or expired token.")
         
         user_id = payload.get("user_id")
+        if not user_id:
+            raise HTTPException(status_code=401, detail="Unauthorized: User ID missing in token.")
         
         # Validate song data
         song = song_data.get('songName')
@@ -728,54 +640,61 @@ async def update_song_history(song_data: dict, request: Request):
         if not song or not artist:
             raise HTTPException(status_code=400, detail="Invalid song data.")
 
-        # Find the user by ID
-        user = await db["users"].find_one({"_id": ObjectId(user_id)})
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found.")
-        
-        # Update the user's history
-        history_entry = {"songName": song, "artistName": artist}
-        result = await db["users"].update_one(
-            {"_id": ObjectId(user_id)},
-            {"$push": {"history": history_entry}}  # Push the song to the history array
-        )
-
-        if result.matched_count == 0:
-            raise HTTPException(status_code=404, detail="User not found.")
-
-        updated_user = await db["users"].find_one({"_id": ObjectId(user_id)})
-        updated_user["_id"] = str(updated_user["_id"])
+        # Accepted into the write-behind buffer; Mongo sees it with the next batch
+        entry = history_store.record(user_id, song, artist)
+        return PlaylistItem(songName=entry["songName"], artistName=entry["artistName"])
 
-        return updated_user
+    except HTTPException as e:
+        raise e
 
     except Exception as e:
         print(f"Error while updating song history: {e}")
         raise HTTPException(status_code=500, detail="An unexpected error occurred while updating song history.")
+
+async def history_page(request: Request, limit: Optional[int], before: Optional[str]):
+    token = request.headers.get("authorization")
+    if not token:
+        raise HTTPException(status_code=401, detail="Unauthorized: Token not found.")
     
-@model_router.get("/get/history", response_model= List[PlaylistItem])
-async def get_history(request: Request):
-    try:
-        token = request.headers.get("authorization")
-        if not token:
-            raise HTTPException(status_code=401, detail="Unauthorized: Token not found.")
-        
-        payload = verify_access_token(token)
-        if not payload:
-            raise HTTPException(status_code=401, detail="Unauthorized: Invalid or expired token.")
-        
-        user_id = payload.get("user_id")
+    payload = verify_access_token(token)
+    if not payload:
+        raise HTTPException(status_code=401, detail="Unauthorized: Invalid or expired token.")
+    
+    user_id = payload.get("user_id")
 
-        if not user_id:
-            raise HTTPException(status_code=401, detail="Unauthorized: User ID missing in token.")
-        
-        user = await db["users"].find_one({"_id":ObjectId(user_id)})
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Unauthorized: User ID missing in token.")
 
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found.")
-        
-        history = user.get("history", [])
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="Limit must be positive.")
+
+    try:
+        return await history_store.page(user_id, limit, before)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid history cursor.")
+
+@model_router.get("/get/history", response_model= List[PlaylistItem])
+async def get_history(request: Request, limit: Optional[int] = None, before: Optional[str] = None):
+    try:
+        # The most recent page, oldest to newest; /get/history/page carries the cursor
+        history, _ = await history_page(request, limit, before)
+        return [PlaylistItem(songName=entry.get("songName"), artistName=entry.get("artistName")) for entry in history]
+    
+    except HTTPException as e:
+        raise e
+    
+    except Exception as e:
+        print(f"Error while fetching song history: {e}")
+        raise HTTPException(status_code=500, detail="An unexpected error occurred while fetching song history.")
 
-        return [PlaylistItem(**entry) for entry in history]
+@model_router.get("/get/history/page", response_model=HistoryPage)
+async def get_history_page(request: Request, limit: Optional[int] = None, before: Optional[str] = None):
+    try:
+        history, next_cursor = await history_page(request, limit, before)
+        return HistoryPage(
+            items=[PlaylistItem(songName=entry.get("songName"), artistName=entry.get("artistName")) for entry in history],
+            next=next_cursor
+        )
     
     except HTTPException as e:
         raise e
@@ -1,33 +1,39 @@
 from fastapi import APIRouter, HTTPException,WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 from controller.controller import search2hls
 from controller.controller import search2hls_rapidapi_noHLS
 from controller.controller import streaming  
 from controller.controller import songdetails
 from controller.controller import get_id
 from controller.controller import get_id_googleapi
+from controller.pipeline import spotify_server, resolve_metadata, resolve_video_id, resolve_stream, resolve, warm_metadata, stage_timings, flights, metadata_cache, spotify_hop
+from controller.providers import provider_stats
+from controller.circuit import circuits
+from controller.cache import stream_cache, search_cache
+from controller.jobs import job_runner
+from controller.segments import segment_cache
+from controller.history import history_buffer
+from controller.prefetch import prefetcher, track_query, PREFETCH_DEPTH, PREFETCH_MAX_DEPTH
 from routes.model import verify_access_token
+from models.model import PlaylistItem
 from dbconfig import db
 import json
-from connection_manager import active_connection
+from connection_manager import manager, ConnectionLimitExceeded
 import asyncio
 from dotenv import load_dotenv
 from pathlib import Path
 import os 
 from pydantic import BaseModel
-import requests
+from typing import Optional, List
+from bson import ObjectId
 
 dotenv_path = Path('./client.env')
 load_dotenv(dotenv_path=dotenv_path)
 
-SPOTIFY_SERVER_URL = str(os.getenv('SPOTIFY_SERVER_URL'))
-
-async def heartbeat(websocket: WebSocket):
-    try:
-        while True:
-            await asyncio.sleep(30)
-            await websocket.send_json({"type":"ping"})
-    except Exception as e:
-        print(f"Heartbeat error or client disconnected: {e}")
+MAX_INFLIGHT_PER_SESSION = int(os.getenv('MAX_INFLIGHT_PER_SESSION', '4'))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '8'))
+BATCH_MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', '16'))
+BATCH_MAX_TRACKS = int(os.getenv('BATCH_MAX_TRACKS', '200'))
 
 async def check_if_liked(artist: str, song: str, token: str) -> bool:
     try:
@@ -37,33 +43,183 @@ async def check_if_liked(artist: str, song: str, token: str) -> bool:
 
         user_id = payload.get("user_id")
         print(user_id)
-        liked_playlist = await db["playlist"].find_one({"userID": user_id, "liked": True})
-        if not liked_playlist:
-            return False
-
-        for item in liked_playlist["songs"]:
-            if item["songName"] == song and item["artistName"] == artist:
-                return True
-        return False
+        # Matched inside MongoDB on the liked_song_lookup index; only the _id comes back
+        liked_playlist = await db["playlist"].find_one(
+            {"userID": user_id, "liked": True, "songs": {"$elemMatch": {"songName": song, "artistName": artist}}},
+            {"_id": 1}
+        )
+        return liked_playlist is not None
     except Exception as e:
         print(f"Error in checking liked song status: {e}")
         return False
 
-async def spotify_server(query: str, server_url: str):
+async def liked_songs(user_id: str) -> set:
+    liked_playlist = await db["playlist"].find_one({"userID": user_id, "liked": True}, {"songs": 1})
+    if not liked_playlist:
+        return set()
+    return {(item.get("songName"), item.get("artistName")) for item in liked_playlist.get("songs") or []}
+
+async def resolve_play(search_query: str, token: str, send=None, progressive: bool = False) -> dict:
+    # Metadata and video ID lookups run side by side; the liked check follows
+    # metadata and the stream lookup follows the video ID. If any step raises,
+    # the TaskGroup cancels everything still in flight.
+    async def emit(frame):
+        if send:
+            await send(frame)
+
+    async def metadata():
+        data = await resolve_metadata(search_query)
+        if not data:
+            raise LookupError("Song details not found")
+        if progressive:
+            await emit({"artist": data['artist'], "song": data['song']})
+        return data
+
+    async def video_id():
+        id = await resolve_video_id(search_query)
+        if progressive:
+            await emit({"id": id})
+        return id
+
+    async def liked(metadata_task):
+        data = await metadata_task
+        return await check_if_liked(data['artist'], data['song'], token)
+
+    async def stream(video_id_task):
+        id = await video_id_task
+        return await resolve_stream(id) if id else None
+
     try:
-        url = f"{server_url}/spotify"
-        response = requests.post(url, params={"query": query})
-        
-        if response.status_code == 200:
-            data = response.json()
-            print(f"Artist: {data['artist']}, Song: {data['song']}")
-            return data
+        async with asyncio.TaskGroup() as tg:
+            metadata_task = tg.create_task(metadata())
+            video_id_task = tg.create_task(video_id())
+            liked_task = tg.create_task(liked(metadata_task))
+            stream_task = tg.create_task(stream(video_id_task))
+
+            data = await metadata_task
+            response = {
+                "artist": data['artist'],
+                "song": data['song'],
+                "id": await video_id_task,
+                "hls": False,
+                "liked": await liked_task
+            }
+            await emit(response)
+
+            stream_link = await stream_task
+    except ExceptionGroup as eg:
+        raise eg.exceptions[0]
+
+    if stream_link:
+        response = {**response, "hls": True, "file": stream_link}
+    return response
+
+async def until_disconnect(connection, coro):
+    # Runs `coro` while listening on the socket so a client that leaves
+    # cancels the work (and any yt-dlp/ffmpeg job it started)
+    work = asyncio.ensure_future(coro)
+    try:
+        while True:
+            listener = asyncio.ensure_future(connection.receive_text())
+            done, _ = await asyncio.wait({work, listener}, return_when=asyncio.FIRST_COMPLETED)
+            if work in done:
+                listener.cancel()
+                return work.result()
+            # Raises WebSocketDisconnect if the client went away; other
+            # frames (e.g. pongs) are ignored while the lookup runs
+            listener.result()
+    finally:
+        work.cancel()
+
+def parse_session_message(message: str):
+    try:
+        parsed = json.loads(message)
+    except ValueError:
+        return None
+    if isinstance(parsed, dict) and "type" in parsed:
+        return parsed
+    return None
+
+async def run_query(send, request_id, search_query: str, token: str, progressive: bool):
+    async def send_tagged(frame):
+        kind = "info" if "hls" in frame else "partial"
+        await send({"type": kind, "request_id": request_id, **frame})
+
+    try:
+        with manager.resolution():
+            result = await resolve_play(search_query, token, send_tagged, progressive)
+        if not result["id"]:
+            await send({"type": "error", "request_id": request_id, "error": "No valid video ID found"})
+        elif result["hls"]:
+            await send({"type": "stream", "request_id": request_id, "hls": True, "file": result["file"], "liked": result["liked"]})
         else:
-            print(f"Error {response.status_code}: {response.json().get('detail')}")
-            return None
+            await send({"type": "error", "request_id": request_id, "error": "Streamable link not found"})
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
-        print(f"Request failed: {e}")
-        return None
+        await send({"type": "error", "request_id": request_id, "error": str(e)})
+
+async def run_session(connection, token: str, first_message: dict, progressive: bool):
+    # One authenticated socket serves many queries. Each query runs as its own
+    # task keyed by request_id so the client can cancel superseded lookups.
+    in_flight = {}
+    send = connection.send_json
+
+    def forget(request_id, task):
+        if in_flight.get(request_id) is task:
+            del in_flight[request_id]
+
+    async def cancel(request_id):
+        task = in_flight.pop(request_id, None)
+        if task:
+            task.cancel()
+            await send({"type": "cancelled", "request_id": request_id})
+
+    async def handle(message: dict):
+        message_type = message.get("type")
+        request_id = message.get("request_id")
+
+        if message_type == "query":
+            search_query = message.get("query")
+            if not search_query or request_id is None:
+                await send({"type": "error", "request_id": request_id, "error": "Missing query or request_id"})
+                return
+
+            if message.get("supersede"):
+                for pending_id in list(in_flight):
+                    await cancel(pending_id)
+            elif request_id in in_flight:
+                await cancel(request_id)
+
+            if len(in_flight) >= MAX_INFLIGHT_PER_SESSION:
+                await send({"type": "error", "request_id": request_id, "error": "Too many queries in flight"})
+                return
+
+            print(f"Search query received: {search_query} ({request_id})")
+            task = asyncio.create_task(run_query(send, request_id, search_query, token, progressive))
+            in_flight[request_id] = task
+            task.add_done_callback(lambda t, rid=request_id: forget(rid, t))
+
+        elif message_type == "cancel":
+            await cancel(request_id)
+
+        elif message_type == "pong":
+            connection.mark_pong()
+
+        else:
+            await send({"type": "error", "request_id": request_id, "error": f"Unknown message type: {message_type}"})
+
+    try:
+        await handle(first_message)
+        while True:
+            message = parse_session_message(await connection.receive_text())
+            if message is None:
+                await send({"type": "error", "error": "Expected a JSON message with a type"})
+                continue
+            await handle(message)
+    finally:
+        for task in in_flight.values():
+            task.cancel()
 
 router = APIRouter()
 
@@ -148,78 +304,75 @@ async def websocket_endpoint_noHLS(websocket: WebSocket):
     print('New websocket connection attempting to connect')
     await websocket.accept()
     print('Websocket accepted')
-    active_connection.add(websocket)
+    try:
+        connection = manager.connect(websocket)
+    except ConnectionLimitExceeded as e:
+        print(f"Rejecting websocket: {e}")
+        await websocket.close(code=1013)
+        return
 
-    heartbeat_task = asyncio.create_task(heartbeat(websocket))
+    close_code = 1000
 
     try:
         print('waiting for auth message')
-        auth_message = await websocket.receive_text()
+        auth_message = await connection.receive_text()
         print(f"Auth message received: {auth_message}")
         if not auth_message:
-            await websocket.close(code=1008)
+            close_code = 1008
             return
         data = json.loads(auth_message)
 
         token = data["token"]
         if not token:
-            await websocket.close(code=1008)
+            close_code = 1008
             return
+
+        payload = verify_access_token(token)
+        manager.assign_user(connection, payload.get("user_id") if payload else None)
         
-        await websocket.send_json({"status": "auth_ok"})
+        progressive = bool(data.get("progressive"))
+
+        await connection.send_json({"status": "auth_ok"})
         print("Auth OK sent, waiting for search query...")
-        search_query = await websocket.receive_text()
+        search_query = await connection.receive_text()
+
+        session_message = parse_session_message(search_query)
+        if session_message is not None:
+            await run_session(connection, token, session_message, progressive)
+            return
+
+        # Legacy clients send one bare query string per connection
         print(f"Search query received: {search_query}")
-        updated_query = search_query[:-4]
-        print("Looking for search details")
-        #artist, song = await songdetails(updated_query)
-        data = await spotify_server(updated_query, SPOTIFY_SERVER_URL)
-        artist = data['artist']
-        song = data['song']
-        print("Search Details found")
-        print(updated_query)
+        with manager.resolution():
+            result = await until_disconnect(connection, resolve_play(search_query, token, connection.send_json, progressive))
         
-        id = await get_id_googleapi(search_query)
-        
-        liked_status = await check_if_liked(artist, song, token)
-
-        await websocket.send_json({
-            "artist": artist,
-            "song": song,
-            "id" : id,
-            "hls": False,
-            "liked" : liked_status 
-        })
-        
-        if id:
-            print('enter')
-            streamLink = await search2hls_rapidapi_noHLS(search_query, websocket)
-            print("Stream Link found")
-
-            if streamLink:
-                if liked_status:
-                    await websocket.send_json({
+        if result["id"]:
+            if result["hls"]:
+                print("Stream Link found")
+                if result["liked"]:
+                    await connection.send_json({
                     "hls": True,
-                    "file": streamLink,
+                    "file": result["file"],
                     "liked" : True
                     }) 
                 else:
-                    await websocket.send_json({
+                    await connection.send_json({
                     "hls": True,
-                    "file": streamLink
+                    "file": result["file"]
                     })
         else:
-            await websocket.send_text("No valid video ID found, aborting.")
+            await connection.send_text("No valid video ID found, aborting.")
 
     except WebSocketDisconnect:
         print("Clinet Disconnected")
+    except ConnectionLimitExceeded as e:
+        print(f"Rejecting websocket: {e}")
+        close_code = 1008
     except Exception as e:
         # Handle any exceptions during the process
-        await websocket.send_text(f"Error: {str(e)}")
+        await connection.send_text(f"Error: {str(e)}")
     finally:
-        heartbeat_task.cancel()
-        active_connection.remove(websocket)
-        await websocket.close()
+        await manager.disconnect(connection, code=close_code)
 
 
 class SearchRequest(BaseModel):
@@ -235,42 +388,179 @@ async def mp3_noHLS(request: SearchRequest):
         if not token or not search_query:
             raise HTTPException(status_code=400, detail="Missing token or search query")
 
-        updated_query = search_query[:-4]
+        print(f"Processing search for: {search_query}")
+
+        response = await resolve_play(search_query, token)
+
+        if not response["id"]:
+            response["error"] = "No valid video ID found"
 
-        print(f"Processing search for: {updated_query}")
+        return response
 
-        data = await spotify_server(updated_query, SPOTIFY_SERVER_URL)
-        artist = data['artist']
-        song = data['song']
+    except Exception as e:
+        print(f"Error occurred: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
+
+
+class PrefetchRequest(BaseModel):
+    token: str
+    playlistID: Optional[str] = None
+    playlistName: Optional[str] = None
+    # Position of the track that just started playing
+    index: int = 0
+    count: int = PREFETCH_DEPTH
+
+@router.post("/prefetch", status_code=202)
+async def prefetch(request: PrefetchRequest):
+    # Resolve the next few tracks of a playlist in the background so the
+    # client's next /ws or /mp3 call is answered from cache
+    try:
+        payload = verify_access_token(request.token)
+        if not payload:
+            raise HTTPException(status_code=401, detail="Unauthorized: Invalid or expired token.")
 
-        video_id = await get_id_googleapi(search_query)
+        query = {"userID": payload.get("user_id")}
+        if request.playlistID:
+            if not ObjectId.is_valid(request.playlistID):
+                raise HTTPException(status_code=400, detail="Invalid playlist ID format.")
+            query["_id"] = ObjectId(request.playlistID)
+        elif request.playlistName:
+            query["name"] = request.playlistName
+        else:
+            raise HTTPException(status_code=400, detail="Missing playlist ID or name")
+
+        count = max(0, min(request.count, PREFETCH_MAX_DEPTH))
+        if not count:
+            # $slice needs a positive limit; nothing to warm anyway
+            return {"tracks": 0, "scheduled": 0}
+        playlist = await db["playlist"].find_one(query, {"songs": {"$slice": [max(request.index + 1, 0), count]}})
+        if not playlist:
+            raise HTTPException(status_code=404, detail="Playlist not found.")
+
+        songs = playlist.get("songs") or []
+        scheduled = prefetcher.schedule([track_query(song) for song in songs])
+        return {"tracks": len(songs), "scheduled": scheduled}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error while scheduling prefetch: {e}")
+        raise HTTPException(status_code=500, detail="An unexpected error occurred while scheduling the prefetch.")
 
-  
-        liked_status = await check_if_liked(artist, song, token)
 
-        # Prepare the initial response
-        response = {
-            "artist": artist,
-            "song": song,
-            "id": video_id,
-            "hls": False,
-            "liked": liked_status
+class BatchResolveRequest(BaseModel):
+    token: str
+    songs: Optional[List[PlaylistItem]] = None
+    playlistID: Optional[str] = None
+    concurrency: int = BATCH_CONCURRENCY
+    # ndjson: one JSON object per line, sse: text/event-stream "result" events
+    format: str = "ndjson"
+
+def encode_frame(frame: dict, format: str, event: str = "result") -> str:
+    data = json.dumps(frame, separators=(",", ":"), ensure_ascii=False)
+    if format == "sse":
+        return f"event: {event}\ndata: {data}\n\n"
+    return data + "\n"
+
+async def batch_frames(items: list, liked: set, concurrency: int, format: str):
+    slots = asyncio.Semaphore(concurrency)
+    await warm_metadata([track_query(item) for item in items])
+
+    async def resolve_item(index: int, item: dict) -> dict:
+        async with slots:
+            try:
+                result = await resolve(track_query(item))
+            except Exception as e:
+                print(f"Batch resolution failed for {item}: {e}")
+                return {"index": index, "error": str(e)}
+
+        if not result["artist"]:
+            return {"index": index, "error": "Song details not found"}
+        if not result["id"]:
+            return {"index": index, "error": "No valid video ID found"}
+        return {
+            "index": index,
+            "artist": result["artist"],
+            "song": result["song"],
+            "id": result["id"],
+            "hls": bool(result["file"]),
+            "file": result["file"],
+            "liked": (result["song"], result["artist"]) in liked
         }
 
-        if video_id:
-            stream_link = await search2hls_rapidapi_noHLS(search_query, None)
-            if stream_link:
-                response["hls"] = True
-                response["file"] = stream_link
+    tasks = [asyncio.create_task(resolve_item(index, item)) for index, item in enumerate(items)]
+    try:
+        # Results go out in completion order; "index" ties them back to the request
+        for next_done in asyncio.as_completed(tasks):
+            yield encode_frame(await next_done, format)
+        yield encode_frame({"done": True, "tracks": len(items)}, format, event="done")
+    finally:
+        # The client went away or the stream failed: stop resolving for nobody
+        for task in tasks:
+            task.cancel()
 
+@router.post("/resolve/batch")
+async def resolve_batch(request: BatchResolveRequest):
+    # One auth check and one liked lookup for the whole playlist instead of one per song
+    try:
+        payload = verify_access_token(request.token)
+        if not payload:
+            raise HTTPException(status_code=401, detail="Unauthorized: Invalid or expired token.")
+        user_id = payload.get("user_id")
+
+        if request.songs is not None:
+            items = [song.dict() for song in request.songs]
+        elif request.playlistID:
+            if not ObjectId.is_valid(request.playlistID):
+                raise HTTPException(status_code=400, detail="Invalid playlist ID format.")
+            playlist = await db["playlist"].find_one({"_id": ObjectId(request.playlistID), "userID": user_id}, {"songs": 1})
+            if not playlist:
+                raise HTTPException(status_code=404, detail="Playlist not found.")
+            items = playlist.get("songs") or []
         else:
-            response["error"] = "No valid video ID found"
+            raise HTTPException(status_code=400, detail="Missing songs or playlist ID")
 
-        return response
+        if len(items) > BATCH_MAX_TRACKS:
+            raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_TRACKS} tracks per batch")
 
+        liked = await liked_songs(user_id)
+        concurrency = max(1, min(request.concurrency, BATCH_MAX_CONCURRENCY))
+        media_type = "text/event-stream" if request.format == "sse" else "application/x-ndjson"
+        return StreamingResponse(batch_frames(items, liked, concurrency, request.format), media_type=media_type)
+
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error occurred: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
+        print(f"Error while starting batch resolution: {e}")
+        raise HTTPException(status_code=500, detail="An unexpected error occurred while resolving the batch.")
+
+
+@router.get("/metrics")
+async def metrics():
+    return {
+        "providers": provider_stats.snapshot(),
+        "stream_cache": stream_cache.stats(),
+        "search_cache": search_cache.stats(),
+        "stages": stage_timings.snapshot(),
+        "connections": manager.stats(),
+        "jobs": job_runner.stats(),
+        "hls_cache": segment_cache.stats(),
+        "singleflight": {stage: flight.stats() for stage, flight in flights.items()},
+        "metadata_cache": metadata_cache.stats(),
+        "prefetch": prefetcher.stats(),
+        "circuits": circuits.snapshot(),
+        "spotify_hop": spotify_hop,
+        "history": history_buffer.stats()
+    }
+
+@router.get("/health")
+async def health():
+    # "degraded" while any upstream is being skipped or probed
+    return {
+        "status": "ok" if circuits.healthy() else "degraded",
+        "circuits": circuits.snapshot(),
+        "providers": provider_stats.snapshot()
+    }
 
 
 @router.get("/home")
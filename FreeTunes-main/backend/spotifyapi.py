@@ -9,6 +9,8 @@ from pydantic import BaseModel, Field
 from fastapi import APIRouter, HTTPException
 from models.model import user, playlist, PlaylistItem
 from dbconfig import db
+import dal
+from controller.history import history_store
 from fastapi.responses import JSONResponse
 
 dotenv_path = Path('./client.env')
@@ -97,11 +99,13 @@ recommendations = APIRouter()
 async def recommendations_get(user_id: str):
     try:
         
-        user_data = await db['users'].find_one({"_id": ObjectId(user_id)})
+        user_data = await dal.find_user(user_id, dal.USER_PROFILE)
         if not user_data:
             raise HTTPException(status_code=404, detail="User not found")
         
         
+        # Seeds come from the most recent plays, not the whole listening history
+        user_data["history"] = await history_store.recent(user_id)
         user_instance = user(**user_data)
 
         
@@ -1,9 +1,15 @@
 from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel
+from typing import List
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
+import asyncio
 import os
+import time
 
 # Load environment variables from .env file
 load_dotenv()
@@ -19,22 +25,80 @@ sp = spotipy.Spotify(
     )
 )
 
+SPOTIFY_CACHE_SIZE = int(os.getenv("SPOTIFY_CACHE_SIZE", "50000"))
+SPOTIFY_CACHE_TTL = float(os.getenv("SPOTIFY_CACHE_TTL", "86400"))
+# Misses are cached briefly so a bad query cannot hammer Spotify
+SPOTIFY_NEGATIVE_TTL = float(os.getenv("SPOTIFY_NEGATIVE_TTL", "300"))
+# spotipy is blocking; searches run on this many threads, off the event loop
+SPOTIFY_WORKERS = int(os.getenv("SPOTIFY_WORKERS", "8"))
+SPOTIFY_BULK_MAX = int(os.getenv("SPOTIFY_BULK_MAX", "100"))
+
+executor = ThreadPoolExecutor(max_workers=SPOTIFY_WORKERS)
+
+class QueryCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        # Returns (found, value); value is None for a cached "not found"
+        entry = self.data.get(key)
+        if entry is None or entry[1] <= time.time():
+            self.data.pop(key, None)
+            self.misses += 1
+            return False, None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return True, entry[0]
+
+    def set(self, key, value, ttl: float):
+        self.data[key] = (value, time.time() + ttl)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+cache = QueryCache(SPOTIFY_CACHE_SIZE)
+# Concurrent requests for the same query share one Spotify search
+in_flight = {}
+
+def normalize_query(search_query: str) -> str:
+    return " ".join(search_query.lower().split())
+
 # Function to get song details
 def songdetails(search_query: str):
-    try:
-        result = sp.search(search_query, type='track', limit=1)
-        if result['tracks']['items']:
-            track = result['tracks']['items'][0]
-            artist = track['artists'][0]['name']
-            song = track['name']
-            print(f"song details server: artist : {artist}, song : {song}")
-            return artist, song
-        else:
-            return None, None
-    except Exception as e:
-        print(f"Error: {e}")
+    # Spotify errors propagate so they are not cached as "not found"
+    result = sp.search(search_query, type='track', limit=1)
+    if result['tracks']['items']:
+        track = result['tracks']['items'][0]
+        artist = track['artists'][0]['name']
+        song = track['name']
+        print(f"song details server: artist : {artist}, song : {song}")
+        return artist, song
+    else:
         return None, None
 
+async def search(search_query: str):
+    key = normalize_query(search_query)
+    found, details = cache.get(key)
+    if found:
+        return details
+
+    task = in_flight.get(key)
+    if task is None:
+        task = asyncio.create_task(fetch_details(key, search_query))
+        in_flight[key] = task
+        task.add_done_callback(lambda finished: in_flight.pop(key, None))
+    return await asyncio.shield(task)
+
+async def fetch_details(key: str, search_query: str):
+    loop = asyncio.get_running_loop()
+    artist, song = await loop.run_in_executor(executor, songdetails, search_query)
+    details = (artist, song) if artist and song else None
+    cache.set(key, details, SPOTIFY_CACHE_TTL if details else SPOTIFY_NEGATIVE_TTL)
+    return details
+
 # Initialize FastAPI app
 app = FastAPI()
 
@@ -57,18 +121,54 @@ async def spotifyapi(request: Request, response: Response):
         if not search_query:
             raise HTTPException(status_code=400, detail="Missing 'query' parameter")
 
-        artist, song = songdetails(search_query)
+        details = await search(search_query)
 
-        if not artist or not song:
+        if not details:
             raise HTTPException(status_code=404, detail="Song not found")
 
+        artist, song = details
         print(f"app.post : {artist} {song}")
         return {
             "artist": artist,
             "song": song
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
 
+class BulkRequest(BaseModel):
+    queries: List[str]
+
+async def bulk_item(search_query: str) -> dict:
+    try:
+        details = await search(search_query)
+    except Exception as e:
+        print(f"Error: {e}")
+        return {"query": search_query, "error": f"Internal Server Error: {e}"}
+    if not details:
+        return {"query": search_query, "error": "Song not found"}
+    return {"query": search_query, "artist": details[0], "song": details[1]}
+
+# Resolve many queries in one round-trip; results keep the request order
+@app.post("/spotify/bulk")
+async def spotifyapi_bulk(request: BulkRequest):
+    if len(request.queries) > SPOTIFY_BULK_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {SPOTIFY_BULK_MAX} queries per request")
+    results = await asyncio.gather(*(bulk_item(query) for query in request.queries))
+    return {"results": results}
+
+@app.get("/stats")
+async def stats():
+    lookups = cache.hits + cache.misses
+    return {
+        "cached": len(cache.data),
+        "hits": cache.hits,
+        "misses": cache.misses,
+        "hit_ratio": cache.hits / lookups if lookups else 0.0,
+        "in_flight": len(in_flight),
+        "workers": SPOTIFY_WORKERS,
+    }
+
 